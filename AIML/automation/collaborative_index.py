@@ -0,0 +1,299 @@
+# collaborative_index.py
+
+import logging
+from typing import Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from config import COLLAB_NEIGHBORS, COLLAB_SIMILARITY_BLOCK
+from database import VoteArrays
+from id_interner import IdInterner
+
+logger = logging.getLogger(__name__)
+
+
+def neighbor_count(n_users: int, n_neighbors: int) -> int:
+    """Neighbours kept per user: n_neighbors, capped by the number of other users."""
+    return min(n_neighbors, max(n_users - 1, 0))
+
+
+def top_n_neighbors(matrix: sp.csr_matrix, n_neighbors: int, rows=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cosine top-N neighbours for the given rows (default: every row with votes)
+    of a sparse user x post matrix.
+
+    Similarities are computed a block of users at a time, so peak memory is
+    COLLAB_SIMILARITY_BLOCK floats instead of a full users x users matrix.
+    Ties are broken by lower user index (same as pandas nlargest). A user is
+    never its own neighbour and users without votes are never neighbours;
+    slots that cannot be filled hold id -1.
+
+    Returns (rows, neighbor_ids, neighbor_sims), the latter two of shape
+    (len(rows), n), sorted best first.
+    """
+    n_users = matrix.shape[0]
+    has_votes = np.diff(matrix.indptr) > 0
+    rows = np.flatnonzero(has_votes) if rows is None else np.asarray(rows, dtype=np.int64)
+    n = neighbor_count(n_users, n_neighbors)
+    neighbor_ids = np.full((rows.size, n), -1, dtype=np.int32)
+    neighbor_sims = np.zeros((rows.size, n), dtype=np.float32)
+    if n == 0 or rows.size == 0:
+        return rows, neighbor_ids, neighbor_sims
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    normed = sp.diags(1.0 / norms).dot(matrix).tocsr()
+    normed_t = normed.T.tocsr()
+    no_votes = np.flatnonzero(~has_votes)
+
+    block_rows = max(1, COLLAB_SIMILARITY_BLOCK // n_users)
+    for start in range(0, rows.size, block_rows):
+        stop = min(start + block_rows, rows.size)
+        block = rows[start:stop]
+        sims = normed[block].dot(normed_t).toarray()
+        sims[:, no_votes] = -np.inf
+        sims[np.arange(block.size), block] = -np.inf
+
+        # n-th largest per row, then keep everything above it plus the
+        # lowest-index ties needed to fill exactly n slots
+        kth = -np.partition(-sims, n - 1, axis=1)[:, n - 1:n]
+        above = sims > kth
+        ties = sims == kth
+        needed = n - above.sum(axis=1, keepdims=True)
+        selected = above | (ties & (np.cumsum(ties, axis=1) <= needed))
+
+        cols = np.nonzero(selected)[1].reshape(stop - start, n)
+        picked = np.take_along_axis(sims, cols, axis=1)
+        order = np.argsort(-picked, axis=1, kind="stable")
+        cols = np.take_along_axis(cols, order, axis=1)
+        picked = np.take_along_axis(picked, order, axis=1)
+
+        empty = np.isneginf(picked)
+        cols[empty] = -1
+        picked[empty] = 0.0
+        neighbor_ids[start:stop] = cols
+        neighbor_sims[start:stop] = picked
+
+    return rows, neighbor_ids, neighbor_sims
+
+
+class CollaborativeIndex:
+    """
+    Sparse user x post vote matrix (CSR) plus a precomputed top-N neighbour
+    list per user. Rows and columns are the shared interned user / post ids,
+    so lookups are array indexing. Memory grows with the number of votes, not
+    users squared.
+    """
+
+    def __init__(self, matrix: sp.csr_matrix, users: IdInterner, posts: IdInterner,
+                 n_neighbors: int = COLLAB_NEIGHBORS):
+        self.matrix = sp.csr_matrix(matrix)
+        self.users = users
+        self.posts = posts
+        self.n_neighbors = n_neighbors
+
+        n = neighbor_count(self.matrix.shape[0], n_neighbors)
+        self.neighbor_ids = np.full((self.matrix.shape[0], n), -1, dtype=np.int32)
+        self.neighbor_sims = np.zeros((self.matrix.shape[0], n), dtype=np.float32)
+        rows, ids, sims = top_n_neighbors(self.matrix, n_neighbors)
+        self.neighbor_ids[rows] = ids
+        self.neighbor_sims[rows] = sims
+        self.vote_keys = _sorted_vote_keys(self.matrix)
+
+    @classmethod
+    def from_vote_arrays(cls, votes: VoteArrays, users: IdInterner, posts: IdInterner,
+                         n_neighbors: int = COLLAB_NEIGHBORS):
+        """Build from the post votes returned by MongoDBConnection.get_vote_arrays."""
+        user_rows = users.intern_many(votes.user_ids)
+        post_cols = posts.intern_many(votes.target_ids)
+        user_idx, post_idx, values = _average_duplicates(
+            votes.user_idx, votes.target_idx, votes.values, len(votes.target_ids)
+        )
+        matrix = sp.csr_matrix(
+            (values, (user_rows[user_idx], post_cols[post_idx])),
+            shape=(len(users), len(posts)),
+        )
+        return cls(matrix, users, posts, n_neighbors)
+
+    def update_users(self, user_ids, votes: VoteArrays) -> int:
+        """
+        Replace the vote rows of `user_ids` with their post votes in `votes`
+        (users without votes end up with an empty row), growing the matrix for
+        newly interned users/posts, then recompute neighbour lists only for
+        users whose top-N can have changed: the updated users, anyone who voted
+        on the same posts, and anyone who had an updated user as a neighbour.
+
+        New structures are built first and swapped in at the end, so concurrent
+        readers never see a half-patched matrix. Returns the number of neighbour
+        lists recomputed.
+        """
+        rows = np.unique(np.concatenate([
+            self.users.intern_many([str(u) for u in user_ids]),
+            self.users.intern_many(votes.user_ids),
+        ]).astype(np.int64))
+        post_cols = self.posts.intern_many(votes.target_ids)
+        n_users, n_posts = len(self.users), len(self.posts)
+        old_users = self.matrix.shape[0]
+
+        # -------- swap the updated users' rows --------
+        matrix = self.matrix.copy()
+        matrix.resize((n_users, n_posts))
+        keep = np.ones(n_users, dtype=np.float32)
+        keep[rows] = 0.0
+        matrix = sp.diags(keep, dtype=np.float32).dot(matrix).tocsr()
+
+        if votes.n_votes:
+            user_rows = self.users.lookup_many(votes.user_ids)
+            user_idx, post_idx, values = _average_duplicates(
+                votes.user_idx, votes.target_idx, votes.values, len(votes.target_ids)
+            )
+            delta = sp.csr_matrix(
+                (values, (user_rows[user_idx], post_cols[post_idx])),
+                shape=(n_users, n_posts),
+            )
+            matrix = matrix + delta
+        matrix.eliminate_zeros()
+
+        # -------- neighbour lists --------
+        n = neighbor_count(n_users, self.n_neighbors)
+        neighbor_ids = np.full((n_users, n), -1, dtype=np.int32)
+        neighbor_sims = np.zeros((n_users, n), dtype=np.float32)
+        if n != self.neighbor_ids.shape[1]:
+            # neighbour width changed (tiny user base): rebuild everything
+            affected, ids, sims = top_n_neighbors(matrix, self.n_neighbors)
+        else:
+            neighbor_ids[:old_users] = self.neighbor_ids
+            neighbor_sims[:old_users] = self.neighbor_sims
+
+            touched_posts = np.unique(matrix[rows].indices)
+            co_voters = np.unique(matrix.tocsc()[:, touched_posts].indices)
+            had_neighbor = np.flatnonzero(np.isin(self.neighbor_ids, rows).any(axis=1))
+            affected = np.unique(np.concatenate([rows, co_voters, had_neighbor]))
+            affected, ids, sims = top_n_neighbors(matrix, self.n_neighbors, affected)
+
+        neighbor_ids[affected] = ids
+        neighbor_sims[affected] = sims
+
+        # a row that lost all its votes has no neighbours
+        empty = affected[np.diff(matrix.indptr)[affected] == 0]
+        neighbor_ids[empty] = -1
+        neighbor_sims[empty] = 0.0
+
+        vote_keys = _sorted_vote_keys(matrix)
+
+        # -------- swap in --------
+        self.matrix = matrix
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_sims = neighbor_sims
+        self.vote_keys = vote_keys
+        return int(affected.size)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def neighbors(self, user_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(neighbour user indices, similarities) for a user; empty if unknown."""
+        row = self.users.lookup(user_id)
+        if row < 0 or row >= self.neighbor_ids.shape[0]:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        ids, sims = self.neighbor_ids[row], self.neighbor_sims[row]
+        valid = ids >= 0
+        return ids[valid], sims[valid]
+
+    def score_batch(self, user_id: str, post_ids) -> np.ndarray:
+        """
+        Collaborative scores for many posts at once: the neighbour list is read
+        once and their votes come from a single sparse row gather.
+
+        Each score is the average non-zero neighbour vote on that post, clipped to
+        [0, 1], or 0.5 (neutral) where there is no evidence.
+        """
+        return self.score_batch_idx(user_id, self.posts.lookup_many(post_ids))
+
+    def score_batch_idx(self, user_id: str, post_idx: np.ndarray) -> np.ndarray:
+        """`score_batch` for interned post indices (-1 = unknown post)."""
+        scores = np.full(len(post_idx), 0.5)
+        neighbor_ids, _ = self.neighbors(user_id)
+        if neighbor_ids.size == 0 or scores.size == 0:
+            return scores
+
+        known = np.flatnonzero((post_idx >= 0) & (post_idx < self.matrix.shape[1]))
+        if known.size == 0:
+            return scores
+
+        votes = self.matrix[neighbor_ids][:, post_idx[known]].toarray()
+        counts = np.count_nonzero(votes, axis=0)
+        sums = votes.sum(axis=0, dtype=np.float64)
+
+        has_votes = counts > 0
+        scores[known[has_votes]] = np.clip(sums[has_votes] / counts[has_votes], 0.0, 1.0)
+        return scores
+
+    def score_pairs(self, user_ids, post_idx: np.ndarray) -> np.ndarray:
+        """
+        `score_batch_idx` for many users at once: post_idx is (n_users, n_candidates)
+        interned post indices (-1 = unknown), one row of candidates per user.
+
+        Every (neighbour, candidate) vote is looked up in one searchsorted over
+        the sorted (row, col) keys kept in `vote_keys`, so the cost is one
+        vectorised pass over n_users x n_neighbors x n_candidates lookups, not a
+        sparse slice per user.
+        """
+        post_idx = np.asarray(post_idx, dtype=np.int64)
+        scores = np.full(post_idx.shape, 0.5)
+        if post_idx.size == 0:
+            return scores
+
+        keys, data, n_cols = self.vote_keys
+        rows = self.users.lookup_many([str(u) for u in user_ids]).astype(np.int64)
+        rows[rows >= self.neighbor_ids.shape[0]] = -1
+        neighbor_ids = np.full((rows.size, self.neighbor_ids.shape[1]), -1, dtype=np.int64)
+        neighbor_ids[rows >= 0] = self.neighbor_ids[rows[rows >= 0]]
+        if neighbor_ids.size == 0 or keys.size == 0:
+            return scores
+
+        # (users, neighbours, candidates) lookups; -1 neighbours / unknown posts never match
+        valid = (neighbor_ids[:, :, None] >= 0) & (post_idx[:, None, :] >= 0) & (post_idx[:, None, :] < n_cols)
+        query = neighbor_ids[:, :, None] * n_cols + post_idx[:, None, :]
+        pos = np.minimum(np.searchsorted(keys, query), keys.size - 1)
+        found = valid & (keys[pos] == query)
+        votes = np.where(found, data[pos], 0.0)
+
+        counts = np.count_nonzero(votes, axis=1)
+        sums = votes.sum(axis=1, dtype=np.float64)
+        has_votes = counts > 0
+        scores[has_votes] = np.clip(sums[has_votes] / counts[has_votes], 0.0, 1.0)
+        return scores
+
+    def score(self, user_id: str, post_id: str) -> float:
+        """Single-post version of `score_batch`."""
+        return float(self.score_batch(user_id, [post_id])[0])
+
+
+def _sorted_vote_keys(matrix: sp.csr_matrix) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    (keys, values, n_cols) with keys = row * n_cols + col sorted ascending, one per
+    stored vote. Built once per matrix so `score_pairs` does not pay O(nnz) per call.
+    """
+    if not matrix.has_canonical_format:
+        # keys must be sorted and unique for the searchsorted lookup
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    n_cols = matrix.shape[1]
+    keys = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr)) * n_cols
+    keys += matrix.indices
+    return keys, matrix.data, n_cols
+
+
+def _average_duplicates(user_idx, post_idx, values, n_posts):
+    """Average duplicate (user, post) pairs, like pivot_table did."""
+    keys = user_idx.astype(np.int64) * max(n_posts, 1) + post_idx
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    if unique_keys.size == keys.size:
+        return user_idx, post_idx, values
+
+    sums = np.bincount(inverse, weights=values)
+    counts = np.bincount(inverse)
+    return unique_keys // n_posts, unique_keys % n_posts, (sums / counts).astype(np.float32)
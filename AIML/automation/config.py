@@ -12,6 +12,16 @@ UPSTASH_REDIS_REST_TOKEN = os.getenv("UPSTASH_REDIS_REST_TOKEN")
 UPSTASH_REDIS_URL = os.getenv("UPSTASH_REDIS_URL")  # redis://:token@host:port
 
 
+# ============================================================================
+# IN-PROCESS (L1) RECOMMENDATION CACHE
+# ============================================================================
+# Users kept in front of Upstash per process, and their estimated total in-memory size
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", 10000))
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Longest a write from another process (e.g. a Celery refresh) can go unseen (0 = disable)
+L1_CACHE_TTL_SECONDS = float(os.getenv("L1_CACHE_TTL_SECONDS", 30))
+
+
 # ============================================================================
 # CELERY CONFIGURATION (Uses Upstash Cloud Redis)
 # ============================================================================
@@ -55,6 +65,8 @@ LOGS_DIR.mkdir(exist_ok=True)
 # ============================================================================
 MONGO_URI = os.getenv("MONGO_URI")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "global_bene")
+# Documents per cursor batch / per column chunk when streaming collections
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", 5000))
 
 
 # ============================================================================
@@ -87,6 +99,47 @@ EMBEDDINGS_PATH = os.getenv(
     "EMBEDDINGS_PATH", 
     str(MODELS_DIR / "post_embeddings.pkl")
 )
+# Cached user profile embeddings (memory-mapped), re-encoded only when the profile text changes
+USER_EMBEDDINGS_DIR = os.getenv(
+    "USER_EMBEDDINGS_DIR",
+    str(MODELS_DIR / "user_embeddings")
+)
+USER_EMBEDDING_DTYPE = os.getenv("USER_EMBEDDING_DTYPE", "float16")
+# Fold the FAISS delta log into a new snapshot after this many updates...
+FAISS_COMPACT_DELTA_OPS = int(os.getenv("FAISS_COMPACT_DELTA_OPS", 200))
+# ...or once this share of index ids belongs to removed posts
+FAISS_COMPACT_TOMBSTONE_RATIO = float(os.getenv("FAISS_COMPACT_TOMBSTONE_RATIO", 0.2))
+# Minutes between incremental post index updates, 1-59 (Celery beat, tasks.update_post_index)
+POST_INDEX_UPDATE_MINUTES = int(os.getenv("POST_INDEX_UPDATE_MINUTES", 10))
+# Expiry of the lock that keeps post index updates from overlapping; longer than the Celery
+# task_time_limit, so the lock of a killed run expires on its own
+POST_INDEX_LOCK_SECONDS = int(os.getenv("POST_INDEX_LOCK_SECONDS", 35 * 60))
+# Index type: flat (exact), ivf_flat, ivf_pq or hnsw
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+# Vectors sampled to train IVF / PQ quantizers
+FAISS_TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", 50000))
+# IVF lists (0 = 4 * sqrt(#posts)) and lists probed per query
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", 0))
+FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", 16))
+# PQ sub-quantizers (must divide EMBEDDING_DIMENSION) and bits per code
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", 48))
+FAISS_PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", 8))
+# HNSW graph degree and build / search beam widths
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", 32))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", 200))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", 128))
+# Memory-map the index and post ids read-only instead of reading them into each process
+FAISS_MMAP = os.getenv("FAISS_MMAP", "true").lower() == "true"
+# With FAISS_MMAP, post changes are only logged and searches serve the published snapshot
+# until the next publish: at least this many minutes after the last one (or at compaction).
+# Lower = fresher results, but every publish rewrites the whole index to disk.
+FAISS_PUBLISH_MINUTES = int(os.getenv("FAISS_PUBLISH_MINUTES", 60))
+# Snapshot versions kept on disk (older ones are deleted when a new one is published)
+FAISS_SNAPSHOTS_KEPT = int(os.getenv("FAISS_SNAPSHOTS_KEPT", 2))
+# OpenMP threads per process for batched FAISS searches (0 = all cores)
+FAISS_OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", 0))
+# Queries used for the recall@k report against exact search
+FAISS_RECALL_QUERIES = int(os.getenv("FAISS_RECALL_QUERIES", 500))
 
 
 # ============================================================================
@@ -98,7 +151,81 @@ MODEL_PATH = os.getenv(
 )
 TOP_K = int(os.getenv("TOP_K", 50))
 EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", 384))
+# Hours a cached list is fresh (soft TTL, checked against its stored timestamp, jittered per entry)...
 CACHE_EXPIRY_HOURS = int(os.getenv("CACHE_EXPIRY_HOURS", 24))
+# ...then how much longer it is still served (marked stale) while a refresh runs; the Redis key
+# expires after both (hard TTL), and only then does the API answer 202. A few hours covers a
+# queued refresh or a late nightly run; longer only serves lists of users who stopped coming back
+CACHE_STALE_HOURS = int(os.getenv("CACHE_STALE_HOURS", 4))
+# At most one on-demand refresh per user is queued within this window (the task releases it when done)
+REFRESH_LOCK_SECONDS = int(os.getenv("REFRESH_LOCK_SECONDS", 120))
+# Cache value encoding written to Upstash: "json" or "packed" (binary ids + float16 scores).
+# Both are always readable; switch to packed once every reader runs a version that decodes it.
+CACHE_VALUE_FORMAT = os.getenv("CACHE_VALUE_FORMAT", "json").lower()
+# Each entry's fresh period is scaled by +/- this fraction (fixed per user and write time) so entries
+# written together go stale and expire spread out
+CACHE_TTL_JITTER = float(os.getenv("CACHE_TTL_JITTER", 0.1))
+
+
+# ============================================================================
+# COLLABORATIVE FILTERING CONFIGURATION
+# ============================================================================
+COLLAB_NEIGHBORS = int(os.getenv("COLLAB_NEIGHBORS", 5))
+# Max similarity entries held in memory at once while building neighbour lists
+COLLAB_SIMILARITY_BLOCK = int(os.getenv("COLLAB_SIMILARITY_BLOCK", 4_000_000))
+# How often the API patches heuristics data with changed posts/users/votes (0 = never)
+HEURISTICS_REFRESH_INTERVAL_SECONDS = int(os.getenv("HEURISTICS_REFRESH_INTERVAL_SECONDS", 300))
+
+
+# ============================================================================
+# TRENDING (COLD-START POPULARITY) CONFIGURATION
+# ============================================================================
+# Popularity decays as exp(-days_old / half-life), days counted back from the newest post
+TRENDING_HALF_LIFE_DAYS = float(os.getenv("TRENDING_HALF_LIFE_DAYS", 7))
+# Posts kept in the global trending list and in each community's list
+TRENDING_GLOBAL_SIZE = int(os.getenv("TRENDING_GLOBAL_SIZE", 5000))
+TRENDING_COMMUNITY_SIZE = int(os.getenv("TRENDING_COMMUNITY_SIZE", 2000))
+# Lifetime of the lists published to Redis (republished every 15 minutes by Celery beat)
+TRENDING_REDIS_TTL_SECONDS = int(os.getenv("TRENDING_REDIS_TTL_SECONDS", 3600))
+
+
+# ============================================================================
+# HYBRID RANKING CONFIGURATION
+# ============================================================================
+# FAISS candidates retrieved per user, then re-ranked with the features below
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 300))
+# Blend weights (normalised to sum to 1): profile similarity, collaborative, cold-start heuristic
+HYBRID_WEIGHT_SIMILARITY = float(os.getenv("HYBRID_WEIGHT_SIMILARITY", 0.6))
+HYBRID_WEIGHT_COLLABORATIVE = float(os.getenv("HYBRID_WEIGHT_COLLABORATIVE", 0.25))
+HYBRID_WEIGHT_COLD_START = float(os.getenv("HYBRID_WEIGHT_COLD_START", 0.15))
+
+
+# ============================================================================
+# NIGHTLY BATCH CONFIGURATION
+# ============================================================================
+# Users pulled from Mongo, encoded and searched together
+NIGHTLY_USER_BATCH_SIZE = int(os.getenv("NIGHTLY_USER_BATCH_SIZE", 1000))
+# Profile texts per SBERT forward pass
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", 256))
+# Users per Upstash pipeline request
+CACHE_WRITE_BATCH_SIZE = int(os.getenv("CACHE_WRITE_BATCH_SIZE", 200))
+# User id ranges processed as parallel Celery subtasks (1 = single task)
+NIGHTLY_SHARDS = int(os.getenv("NIGHTLY_SHARDS", 8))
+# A crashed / timed-out run resumes from its checkpoint if restarted within this window
+NIGHTLY_CHECKPOINT_TTL_SECONDS = int(os.getenv("NIGHTLY_CHECKPOINT_TTL_SECONDS", 6 * 3600))
+
+
+# ============================================================================
+# CACHE PRE-WARMING
+# ============================================================================
+# Only users active within this many days are pre-warmed, most recently active first
+PREWARM_ACTIVITY_DAYS = int(os.getenv("PREWARM_ACTIVITY_DAYS", 7))
+PREWARM_MAX_USERS = int(os.getenv("PREWARM_MAX_USERS", 20000))
+# Refresh entries that are missing or expire within this window (keep it above the schedule interval)
+PREWARM_AHEAD_SECONDS = int(os.getenv("PREWARM_AHEAD_SECONDS", 2 * 3600))
+# Throttle: users per refresh batch and pause between batches
+PREWARM_BATCH_SIZE = int(os.getenv("PREWARM_BATCH_SIZE", 500))
+PREWARM_BATCH_PAUSE_SECONDS = float(os.getenv("PREWARM_BATCH_PAUSE_SECONDS", 2.0))
 
 
 # ============================================================================
@@ -108,6 +235,8 @@ API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", 8000))
 API_TITLE = os.getenv("API_TITLE", "GlobalBene Recommendation Engine")
 API_VERSION = os.getenv("API_VERSION", "1.0.0")
+# Threads per API worker for cold-start ranking, kept off the event loop
+API_RANKING_WORKERS = int(os.getenv("API_RANKING_WORKERS", 4))
 
 
 # ============================================================================
@@ -1,11 +1,31 @@
 from pymongo import MongoClient
-from config import MONGO_URI, DATABASE_NAME
+from config import MONGO_URI, DATABASE_NAME, MONGO_BATCH_SIZE
+from itertools import islice
+from typing import NamedTuple
+import numpy as np
 import pandas as pd
 from bson import ObjectId
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class VoteArrays(NamedTuple):
+    """
+    Flattened votes, ready to feed a sparse matrix:
+    vote i is user_ids[user_idx[i]] voting values[i] on target_ids[target_idx[i]].
+    """
+    user_idx: np.ndarray    # int32
+    target_idx: np.ndarray  # int32
+    values: np.ndarray      # float32
+    user_ids: np.ndarray    # str ids, sorted
+    target_ids: np.ndarray  # str ids, sorted
+
+    @property
+    def n_votes(self):
+        return int(self.values.size)
+
+
 class MongoDBConnection:
     def __init__(self):
         try:
@@ -17,30 +37,111 @@ class MongoDBConnection:
             logger.error(f"✗ MongoDB connection failed: {e}")
             raise
     
-    def _convert_objectid_to_str(self, data):
-        if isinstance(data, list):
-            for item in data:
-                if '_id' in item and isinstance(item['_id'], ObjectId):
-                    item['_id'] = str(item['_id'])
-        return data
-    
-    def get_users(self, filter_query=None):
+    def iter_collection(self, collection, filter_query=None, projection=None,
+                        batch_size=MONGO_BATCH_SIZE, id_column=None, sort=None):
+        """
+        Stream a collection straight from the cursor as column-oriented chunks.
+
+        Args:
+            collection: Collection name
+            filter_query: Mongo filter (default: everything)
+            projection: List of fields to fetch (dotted paths allowed); None = all
+            batch_size: Max documents per chunk
+            id_column: Rename '_id' to this column name
+            sort: Optional pymongo sort spec, e.g. [('_id', 1)]
+
+        Yields:
+            Dict mapping column name -> list of values (at most batch_size rows),
+            with ObjectIds (including inside lists) converted to str on the fly
+        """
+        if filter_query is None:
+            filter_query = {}
+
+        fields = list(projection) if projection is not None else None
+        if fields is not None and '_id' not in fields:
+            fields.insert(0, '_id')
+
+        cursor = self.db[collection].find(filter_query, fields, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        while True:
+            docs = list(islice(cursor, batch_size))
+            if not docs:
+                break
+
+            columns = fields or list(dict.fromkeys(key for doc in docs for key in doc))
+            chunk = {
+                (id_column if col == '_id' and id_column else col):
+                    [_to_plain(_get_path(doc, col)) for doc in docs]
+                for col in columns
+            }
+            yield chunk
+
+    def iter_users(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE, sort=None):
+        return self.iter_collection('users', filter_query, projection, batch_size, id_column='user_id', sort=sort)
+
+    def iter_posts(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE, sort=None):
+        return self.iter_collection('posts', filter_query, projection, batch_size, id_column='post_id', sort=sort)
+
+    def get_id_boundaries(self, collection, n_parts):
+        """
+        Split a collection's _id space into n_parts contiguous ranges of about
+        equal size. Returns the n_parts - 1 cut points as str ids (ascending);
+        fewer if the collection has fewer documents than parts.
+        """
+        total = self.db[collection].count_documents({})
+        if n_parts <= 1 or total == 0:
+            return []
+
+        boundaries = []
+        for part in range(1, n_parts):
+            skip = part * total // n_parts
+            doc = next(self.db[collection].find({}, ['_id']).sort('_id', 1).skip(skip).limit(1), None)
+            if doc is not None and (not boundaries or str(doc['_id']) != boundaries[-1]):
+                boundaries.append(str(doc['_id']))
+        return boundaries
+
+    def get_recently_active_user_ids(self, since, limit):
+        """
+        Ids of users active since `since` (datetime), most recently active
+        first, at most `limit`. A user's last activity is the later updatedAt
+        of their votes document (voting) and user document (profile changes).
+        """
+        last_active = {}
+        for collection, id_field in (('votes', 'user_id'), ('users', '_id')):
+            cursor = (
+                self.db[collection]
+                .find({'updatedAt': {'$gte': since}}, [id_field, 'updatedAt'])
+                .sort('updatedAt', -1)
+                .limit(limit)
+            )
+            for doc in cursor:
+                if doc.get(id_field) is None:
+                    continue
+                user_id = str(doc[id_field])
+                if user_id not in last_active or doc['updatedAt'] > last_active[user_id]:
+                    last_active[user_id] = doc['updatedAt']
+
+        ranked = sorted(last_active, key=last_active.get, reverse=True)[:limit]
+        logger.info(f"✓ Found {len(ranked)} users active since {since}")
+        return ranked
+
+    def _chunks_to_df(self, chunks):
+        frames = [pd.DataFrame(chunk) for chunk in chunks]
+        if not frames:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def get_users(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
         try:
-            if filter_query is None:
-                filter_query = {}
-            
-            users_bson = list(self.db['users'].find(filter_query))
-            
-            if not users_bson:
+            users_df = self._chunks_to_df(self.iter_users(filter_query, projection, batch_size))
+
+            if users_df.empty:
                 logger.warning("No users found")
                 return pd.DataFrame()
-            
-            users_bson = self._convert_objectid_to_str(users_bson)
-            users_df = pd.DataFrame(users_bson)
-            
-            if '_id' in users_df.columns:
-                users_df = users_df.rename(columns={'_id': 'user_id'})
-            
+
             logger.info(f"✓ Fetched {len(users_df)} users")
             return users_df
             
@@ -48,23 +149,14 @@ class MongoDBConnection:
             logger.error(f"✗ Error fetching users: {e}")
             return pd.DataFrame()
     
-    def get_posts(self, filter_query=None):
+    def get_posts(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
         try:
-            if filter_query is None:
-                filter_query = {}
-            
-            posts_bson = list(self.db['posts'].find(filter_query))
-            
-            if not posts_bson:
+            posts_df = self._chunks_to_df(self.iter_posts(filter_query, projection, batch_size))
+
+            if posts_df.empty:
                 logger.warning("No posts found")
                 return pd.DataFrame()
-            
-            posts_bson = self._convert_objectid_to_str(posts_bson)
-            posts_df = pd.DataFrame(posts_bson)
-            
-            if '_id' in posts_df.columns:
-                posts_df = posts_df.rename(columns={'_id': 'post_id'})
-            
+
             logger.info(f"✓ Fetched {len(posts_df)} posts")
             return posts_df
             
@@ -72,6 +164,86 @@ class MongoDBConnection:
             logger.error(f"✗ Error fetching posts: {e}")
             return pd.DataFrame()
 
+    def get_vote_arrays(self, target_type='post', filter_query=None, batch_size=MONGO_BATCH_SIZE):
+        """
+        Flatten votes.<target_type>.target_ids of every votes document into
+        typed arrays (see VoteArrays).
+
+        The aggregation projects only the user id, the target id array and the
+        value, with ids converted to strings server-side. Target arrays are
+        flattened client-side with list.extend rather than $unwind, which would
+        ship one document per vote over the wire.
+
+        Args:
+            target_type: 'post' or 'comment'
+            filter_query: Mongo filter on the votes documents
+            batch_size: Cursor batch size
+
+        Raises the driver's error if the read fails (logged here first).
+        """
+        field = f'$votes.{target_type}'
+        pipeline = [
+            {'$match': filter_query or {}},
+            {'$project': {
+                '_id': 0,
+                'user_id': {'$toString': {'$ifNull': ['$user_id', '$_id']}},
+                'target_ids': {'$map': {
+                    'input': {'$ifNull': [f'{field}.target_ids', []]},
+                    'as': 'tid',
+                    'in': {'$toString': '$$tid'},
+                }},
+                'value': {'$ifNull': [f'{field}.value', 0]},
+            }},
+            {'$match': {'target_ids.0': {'$exists': True}}},
+        ]
+
+        try:
+            doc_users, doc_values, doc_counts, targets = [], [], [], []
+            for doc in self.db['votes'].aggregate(pipeline, batchSize=batch_size, allowDiskUse=True):
+                doc_users.append(doc['user_id'])
+                doc_values.append(doc['value'])
+                doc_counts.append(len(doc['target_ids']))
+                targets.extend(doc['target_ids'])
+        except Exception as e:
+            # an outage must not look like "no votes": callers would drop everyone's vote rows
+            logger.error(f"✗ Error fetching {target_type} votes: {e}")
+            raise
+
+        user_codes, user_ids = pd.factorize(np.asarray(doc_users, dtype=object), sort=True)
+        target_codes, target_ids = pd.factorize(np.asarray(targets, dtype=object), sort=True)
+        counts = np.asarray(doc_counts, dtype=np.int64)
+        # non-numeric values count as 0 and fractions are truncated, like int()
+        doc_values = np.trunc(pd.to_numeric(pd.Series(doc_values, dtype=object), errors='coerce').fillna(0))
+
+        votes = VoteArrays(
+            user_idx=np.repeat(user_codes.astype(np.int32), counts),
+            target_idx=target_codes.astype(np.int32),
+            values=np.repeat(doc_values.to_numpy(dtype=np.float32), counts),
+            user_ids=np.asarray(user_ids, dtype=object),
+            target_ids=np.asarray(target_ids, dtype=object),
+        )
+        logger.info(f"✓ Fetched {votes.n_votes} {target_type} votes from {len(doc_users)} users")
+        return votes
+
+
+def _get_path(doc, path):
+    """Follow a dotted field path into a document; None if any part is missing."""
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _to_plain(value):
+    """ObjectId -> str, also inside lists (e.g. communities_followed)."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, list):
+        return [str(v) if isinstance(v, ObjectId) else v for v in value]
+    return value
+
 _mongo_connection = None
 
 def get_mongo_connection():
@@ -90,6 +262,15 @@ def get_all_users():
     # Convert DataFrame to list of dicts
     return users_df.to_dict(orient='records') if not users_df.empty else []
 
+def id_range_filter(lower=None, upper=None):
+    """Mongo filter for lower <= _id < upper (str ids; None = unbounded)."""
+    bounds = {}
+    if lower is not None:
+        bounds['$gte'] = ObjectId(lower)
+    if upper is not None:
+        bounds['$lt'] = ObjectId(upper)
+    return {'_id': bounds} if bounds else {}
+
 def get_user_data(user_id):
     """
     Return a dict for the user with given user_id; None if not found.
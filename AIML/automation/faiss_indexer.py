@@ -1,17 +1,73 @@
 # faiss_indexer.py
 
+import os
+import shutil
+import time
 import faiss
 import numpy as np
 import pickle
 import logging
-from config import FAISS_INDEX_PATH
+from file_lock import file_lock
+from config import (
+    FAISS_INDEX_PATH,
+    FAISS_COMPACT_DELTA_OPS,
+    FAISS_COMPACT_TOMBSTONE_RATIO,
+    FAISS_INDEX_TYPE,
+    FAISS_TRAIN_SAMPLE,
+    FAISS_IVF_NLIST,
+    FAISS_IVF_NPROBE,
+    FAISS_PQ_M,
+    FAISS_PQ_NBITS,
+    FAISS_HNSW_M,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_HNSW_EF_SEARCH,
+    FAISS_RECALL_QUERIES,
+    FAISS_MMAP,
+    FAISS_PUBLISH_MINUTES,
+    FAISS_SNAPSHOTS_KEPT,
+    FAISS_OMP_THREADS,
+    TOP_K,
+)
 
 logger = logging.getLogger(__name__)
 
+# 0 = let FAISS use every core for multi-query searches
+if FAISS_OMP_THREADS > 0:
+    faiss.omp_set_num_threads(FAISS_OMP_THREADS)
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+
 class FAISSIndexer:
-    def __init__(self):
+    """
+    Cosine-similarity post index whose FAISS ids are positions in
+    self.post_ids (b"" = removed, until compact() renumbers), so posts can be
+    added, replaced and removed without a rebuild. index_type is "flat",
+    "ivf_flat", "ivf_pq" or "hnsw" (FAISS_INDEX_TYPE); ivf_pq is never
+    retrained on its own PQ reconstructions.
+
+    Versioned snapshots live under <index>_snapshots/ (CURRENT names the live
+    one); changes since a snapshot go to its delta log. With FAISS_MMAP the
+    snapshot is mapped read-only and served until the next publish.
+    """
+
+    def __init__(self, index_type=FAISS_INDEX_TYPE):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown FAISS index type {index_type!r}, expected one of {INDEX_TYPES}")
+        self.index_type = index_type
+        self.nprobe = FAISS_IVF_NPROBE
+        self.ef_search = FAISS_HNSW_EF_SEARCH
         self.index = None
-        self.post_ids = []
+        self.post_ids = _ids_array([])
+        self._n_live = 0
+        self._id_changes = 0
+        self._reset_keys()
+        self._mmapped = False
+        self.filepath = None
+        self._delta_ops = 0
+        self._delta_offset = 0
+        self._version = None
+        self.built_at = None
 
     def create_index_cosine(self, embeddings, post_ids):
         """Build FAISS index using cosine similarity"""
@@ -19,51 +75,770 @@ class FAISSIndexer:
         embeddings = embeddings.astype('float32')
         faiss.normalize_L2(embeddings)
 
-        dimension = int(embeddings.shape[1])
-        self.index = faiss.IndexFlatIP(dimension)
+        self.index = self._build(embeddings, np.arange(len(post_ids), dtype='int64'))
+        self.post_ids = _ids_array([str(post_id) for post_id in post_ids])
+        self._n_live = len(self.post_ids)
+        self._reset_keys()
+        self._mmapped = False
+        self.built_at = time.time()
+
+    def search(self, query_vector, k=50, exclude=None, allowed=None):
+        """
+        Search for K nearest neighbors.
+
+        query_vector may be a single vector or an (n, d) matrix of queries
+        (one id list per row). See search_batch for the filters; for a single
+        vector `exclude` is one iterable of post ids.
+        """
+
+        query_vector = np.asarray(query_vector)
+        if query_vector.ndim != 1:
+            distances, post_ids = self.search_batch(query_vector, k, exclude, allowed)
+            return distances, post_ids.tolist()
+
+        query_vector = np.expand_dims(query_vector, axis=0)  # Make 2D
+        distances, post_ids = self.search_batch(
+            query_vector, k, None if exclude is None else [exclude], allowed
+        )
+
+        # post_ids is shape (1, k). Flatten it
+        return distances, post_ids[0].tolist()
+
+    def search_batch(self, queries, k=50, exclude=None, allowed=None):
+        """
+        Search an (n, d) query matrix in one FAISS call (FAISS parallelises
+        over queries with OpenMP, see FAISS_OMP_THREADS).
 
-        self.index.add(embeddings)
-        self.post_ids = post_ids
+        Returns (distances, post_ids): float32 (n, k) and an (n, k) object
+        array of post ids, None where FAISS could not fill a slot. Ids are
+        gathered from post_ids in one step and only those hits are decoded.
 
-    def search(self, query_vector, k=50):
-        """Search for K nearest neighbors"""
+        Filters, so that the k results are usable as they are:
+            allowed: boolean mask over FAISS ids (see id_mask) of posts that
+                may be returned, applied inside FAISS through an ID selector.
+            exclude: one iterable of post ids per query row that must not be
+                returned (e.g. already voted on). Applied by over-fetching and
+                dropping them. Each row over-fetches by its own exclusion count
+                rounded up to a power of two; rows with the same amount share
+                one FAISS call, so one heavy voter does not widen every row.
+        """
 
         if self.index is None:
             raise RuntimeError("FAISS index is not loaded. Call load_index() first.")
 
-        query_vector = query_vector.astype('float32')
-        query_vector = np.expand_dims(query_vector, axis=0)  # Make 2D
+        queries = np.array(queries, dtype='float32')
+        faiss.normalize_L2(queries)
+
+        exclude_rows, exclude_ids = self._exclusions(exclude)
+        allowed = self._allowed_mask(allowed)
+        params = None
+        if allowed is not None:
+            packed = np.packbits(allowed, bitorder='little')
+            selector = faiss.IDSelectorBitmap(len(packed), faiss.swig_ptr(packed))  # size in bytes
+            params = self._search_params(selector)
+
+        if not exclude_ids.size:
+            distances, indices = self.index.search(queries, k, params=params)
+            return distances, self._post_ids_of(indices)
+
+        counts = np.bincount(exclude_rows, minlength=len(queries))
+        extra = np.zeros(len(queries), dtype='int64')
+        extra[counts > 0] = 2 ** np.ceil(np.log2(counts[counts > 0])).astype('int64')
+        distances = np.empty((len(queries), k), dtype='float32')
+        indices = np.empty((len(queries), k), dtype='int64')
+        local_row = np.empty(len(queries), dtype='int64')
+        for over_fetch in np.unique(extra):
+            rows = np.flatnonzero(extra == over_fetch)
+            fetch = min(k + int(over_fetch), max(k, self.index.ntotal))
+            row_distances, row_indices = self.index.search(queries[rows], fetch, params=params)
+            if over_fetch:
+                local_row[rows] = np.arange(len(rows))
+                in_rows = extra[exclude_rows] == over_fetch
+                row_distances, row_indices = self._drop_excluded(
+                    row_distances, row_indices, local_row[exclude_rows[in_rows]], exclude_ids[in_rows], k
+                )
+            distances[rows] = row_distances
+            indices[rows] = row_indices
+
+        return distances, self._post_ids_of(indices)
+
+    def _post_ids_of(self, indices):
+        """Object array of the post ids at FAISS ids `indices`, None for -1 (unfilled) and removed posts."""
+        post_ids = np.full(indices.shape, None, dtype=object)
+        filled = indices >= 0
+        if filled.any():
+            found = self.post_ids[indices[filled]]
+            hits = found != b""
+            rows = np.flatnonzero(filled.ravel())[hits]
+            post_ids.ravel()[rows] = np.char.decode(found[hits], 'utf-8')
+        return post_ids
+
+    def faiss_ids(self, post_ids):
+        """FAISS ids of post ids (int64), -1 for posts not in the index."""
+        keys = _ids_array(list(post_ids))
+        ids = np.full(len(keys), -1, dtype='int64')
+        if not len(keys) or not self._n_live:
+            return ids
+        for sorted_keys, key_ids in (self._keys_index(), self._tail_index()):
+            if not len(sorted_keys):
+                continue
+            pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+            candidate = np.asarray(key_ids[pos], dtype='int64')
+            # removed (or replaced) posts keep their key but their post_ids slot is b""
+            live = (sorted_keys[pos] == keys) & (self.post_ids[candidate] == keys)
+            ids[live] = candidate[live]
+        return ids
+
+    def id_mask(self, post_ids):
+        """Boolean mask over FAISS ids, True for the given posts - the `allowed` argument of search()."""
+        mask = np.zeros(len(self.post_ids), dtype=bool)
+        ids = self.faiss_ids(post_ids)
+        mask[ids[ids >= 0]] = True
+        return mask
+
+    def _allowed_mask(self, allowed):
+        """Caller's mask sized to the current ids (posts added since are not allowed), minus HNSW tombstones."""
+        if allowed is not None and len(allowed) != len(self.post_ids):
+            resized = np.zeros(len(self.post_ids), dtype=bool)
+            n = min(len(allowed), len(resized))
+            resized[:n] = allowed[:n]
+            allowed = resized
+        if self.tombstones and isinstance(self._inner(), faiss.IndexHNSW):
+            live = self.post_ids != b""
+            allowed = live if allowed is None else (allowed & live)
+        return allowed
+
+    def _search_params(self, selector):
+        inner = self._inner()
+        if isinstance(inner, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=min(self.nprobe, inner.nlist))
+        if isinstance(inner, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+        return faiss.SearchParameters(sel=selector)
+
+    def _exclusions(self, exclude):
+        """Per-row exclusion lists -> flat (row, FAISS id) arrays, dropping posts not in the index."""
+        if exclude is None:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+        exclude = [list(row) for row in exclude]
+        rows = np.repeat(np.arange(len(exclude), dtype='int64'), [len(row) for row in exclude])
+        ids = self.faiss_ids([post_id for row in exclude for post_id in row])
+        known = ids >= 0
+        return rows[known], ids[known]
+
+    def _drop_excluded(self, distances, indices, exclude_rows, exclude_ids, k):
+        """Remove excluded ids from each row of an over-fetched result, keeping order, then cut to k."""
+        width = len(self.post_ids) + 1
+        row_base = np.arange(len(indices), dtype='int64')[:, None] * width
+        dropped = np.isin(row_base + indices + 1, exclude_rows * width + exclude_ids + 1) | (indices < 0)
+
+        order = np.argsort(dropped, axis=1, kind='stable')[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+        dropped = np.take_along_axis(dropped, order, axis=1)
+        indices[dropped] = -1
+        distances[dropped] = -np.finfo('float32').max
+        return distances, indices
+
+    def _reset_keys(self, keys=None, key_ids=None):
+        """Use (keys, key_ids) as the sorted lookup of the current post_ids; None = build it on first use."""
+        self._keys = keys
+        self._key_ids = key_ids
+        self._keyed = len(self.post_ids) if keys is not None else None
+        self._tail = None
+        self._id_changes += 1
 
-        faiss.normalize_L2(query_vector)
+    def _keys_index(self):
+        """(sorted live post ids, their FAISS ids) for post_ids[:self._keyed], from the snapshot when it has one."""
+        if self._keys is None:
+            self._keys, self._key_ids = _sorted_keys(self.post_ids, 0)
+            self._keyed = len(self.post_ids)
+            self._tail = None
+        return self._keys, self._key_ids
 
-        distances, indices = self.index.search(query_vector, k)
+    def _tail_index(self):
+        """Same for the posts added since (delta log replay, upserts): small, kept in memory."""
+        self._keys_index()
+        if self._tail is None:
+            self._tail = _sorted_keys(self.post_ids, self._keyed)
+        return self._tail
 
-        # indices is shape (1, k). Flatten it
-        indices = indices[0]
-        result_post_ids = [self.post_ids[idx] for idx in indices]
+    @property
+    def ids_version(self):
+        """Goes up whenever FAISS ids are assigned, removed or renumbered (cache key for id_mask results)."""
+        return self._id_changes
 
-        return distances, result_post_ids
+    def __len__(self):
+        return self._n_live
 
+    def __contains__(self, post_id):
+        return bool(self.faiss_ids([post_id])[0] >= 0)
+
+    # ------------------------------------------------------------------
+    # Incremental updates
+    # ------------------------------------------------------------------
+    def add_posts(self, embeddings, post_ids):
+        """Add new posts. Raises ValueError for posts already in the index (use upsert_posts)."""
+
+        post_ids = [str(post_id) for post_id in post_ids]
+        existing = [post_id for post_id, i in zip(post_ids, self.faiss_ids(post_ids)) if i >= 0]
+        if existing:
+            raise ValueError(f"{len(existing)} posts already indexed, e.g. {existing[0]}")
+        if not post_ids:
+            return 0
+
+        embeddings = np.array(embeddings, dtype='float32')
+        faiss.normalize_L2(embeddings)
+        if not self._mmapped:
+            self._apply_add(embeddings, post_ids)
+        self._log_delta("add", post_ids, embeddings)
+        return len(post_ids)
+
+    def remove_posts(self, post_ids):
+        """Remove posts from the index; unknown ids are ignored. Returns #removed."""
+
+        post_ids = list(dict.fromkeys(str(post_id) for post_id in post_ids))
+        ids = self.faiss_ids(post_ids)
+        known = ids >= 0
+        if self._mmapped:
+            # the snapshot does not know about posts added since it was published:
+            # log every id, the replay ignores the ones that were never indexed
+            if post_ids:
+                self._log_delta("remove", post_ids, None)
+            return int(known.sum())
+        if not known.any():
+            return 0
+
+        self._apply_remove(ids[known])
+        post_ids = [post_id for post_id, is_known in zip(post_ids, known) if is_known]
+        self._log_delta("remove", post_ids, None)
+        return len(post_ids)
+
+    def upsert_posts(self, embeddings, post_ids):
+        """Add posts, replacing the vectors of posts that are already indexed. Returns #posts written."""
+
+        post_ids = [str(post_id) for post_id in post_ids]
+        if not post_ids:
+            return 0
+
+        # last occurrence wins if a post is listed twice
+        last = {post_id: i for i, post_id in enumerate(post_ids)}
+        rows = np.fromiter(last.values(), dtype='int64', count=len(last))
+        post_ids = list(last)
+        embeddings = np.array(embeddings, dtype='float32')[rows]
+        faiss.normalize_L2(embeddings)
+
+        if not self._mmapped:
+            existing = self.faiss_ids(post_ids)
+            if (existing >= 0).any():
+                self._apply_remove(existing[existing >= 0])
+            self._apply_add(embeddings, post_ids)
+        self._log_delta("upsert", post_ids, embeddings)
+        return len(post_ids)
+
+    def _apply_add(self, embeddings, post_ids):
+        """Add normalized vectors under fresh FAISS ids."""
+        if self.index is None:
+            self.index = self._new_index(embeddings)
+            self._apply_search_params()
+
+        self._keys_index()  # the keys cover the ids before this add; new ones go to the tail
+        start = len(self.post_ids)
+        self.index.add_with_ids(embeddings, np.arange(start, start + len(post_ids), dtype='int64'))
+        self.post_ids = np.concatenate([self.post_ids, _ids_array(post_ids)])
+        self._n_live += len(post_ids)
+        self._tail = None
+        self._id_changes += 1
+
+    def _apply_remove(self, ids):
+        """Remove live posts by FAISS id (see faiss_ids)."""
+        if not isinstance(self._inner(), faiss.IndexHNSW):
+            self.index.remove_ids(ids)
+        self.post_ids[ids] = b""
+        self._n_live -= len(ids)
+        self._tail = None
+        self._id_changes += 1
+
+    def _materialize(self):
+        """
+        Read a memory-mapped snapshot into memory again, with its delta log
+        applied, before publishing it. Reading index.bin without mmap flags is
+        cheaper than a serialize / deserialize round trip (twice its size) and
+        drops the on-disk (read-only) inverted lists of a mapped IVF index.
+        The caller must not hold the exclusive snapshot lock.
+        """
+        if not self._mmapped:
+            return
+        built_at = self.built_at  # may already be set for the snapshot about to be published
+        self._load_snapshot(self.filepath, mmap=False)
+        self.built_at = built_at
+
+    def publish_due(self):
+        """True if logged changes wait for a mapped snapshot and FAISS_PUBLISH_MINUTES have passed since it was published."""
+        if not self._mmapped or self._delta_ops == 0:
+            return False
+        return time.time_ns() - int(self._version) >= FAISS_PUBLISH_MINUTES * 60 * 10**9
+
+    @property
+    def tombstones(self):
+        return len(self.post_ids) - len(self)
+
+    def needs_compaction(self):
+        """True once the delta log or the share of removed ids is big enough to fold into a new snapshot."""
+        if self._delta_ops >= FAISS_COMPACT_DELTA_OPS:
+            return True
+        if self._lossy():
+            return False  # compaction would not drop its tombstones (see compact)
+        return len(self.post_ids) > 0 and self.tombstones / len(self.post_ids) >= FAISS_COMPACT_TOMBSTONE_RATIO
+
+    def _lossy(self):
+        """True if the index only holds PQ codes, so reconstructions are not the original vectors."""
+        return self.built_type == "ivf_pq"
+
+    def compact(self, filepath=None):
+        """
+        Rebuild the index with only live posts under dense ids 0..n-1, write a
+        new snapshot and truncate the delta log. An ivf_pq index only keeps PQ
+        codes, so it is written as it is; changing its type or quantizers takes
+        a rebuild from the post embeddings (create_index_cosine).
+        """
+
+        filepath = filepath or self.filepath or FAISS_INDEX_PATH
+        self._materialize()
+        if self._lossy():
+            # removed vectors are already gone from the IVF lists; only their id slots stay
+            logger.info("🧹 Keeping ivf_pq codes and ids as they are (no retraining on PQ reconstructions)")
+        elif len(self):
+            self._rebuild_live()
+
+        self.save_index(filepath)
+        logger.info(f"🧹 FAISS index compacted. #posts = {len(self)} ({self.built_type})")
+
+    def _rebuild_live(self):
+        """Rebuild self.index_type in memory from the live posts, under dense ids 0..n-1."""
+
+        labels, vectors = self._live_vectors()
+        # IVF / PQ quantizers are retrained on the current posts
+        self.index = self._build(vectors, np.arange(len(labels), dtype='int64'))
+        self.post_ids = np.array(self.post_ids[labels])
+        self._n_live = len(self.post_ids)
+        self._reset_keys()
+        self._mmapped = False
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
     def save_index(self, filepath=FAISS_INDEX_PATH):
-        """Save index to disk"""
+        """
+        Publish the in-memory index as a new snapshot (its delta log starts
+        empty). With FAISS_MMAP the writer then maps it like every reader does
+        instead of keeping a private copy.
+        """
+
+        self._materialize()
+        with _snapshot_lock(filepath):
+            self._publish_snapshot(filepath)
+        if FAISS_MMAP:
+            self._load_snapshot(filepath, mmap=True)
 
-        faiss.write_index(self.index, filepath)
+    def _publish_snapshot(self, filepath, delta_log=None):
+        """
+        Write index, ids and delta log (empty, or a copy of delta_log) into a new
+        version directory under <index>_snapshots/, then point the CURRENT
+        manifest at it with one atomic rename: a reader sees the old snapshot or
+        the new one, never a mix. Caller holds the exclusive snapshot lock.
+        """
 
-        ids_filepath = filepath.replace('.bin', '_ids.pkl')
-        with open(ids_filepath, 'wb') as f:
-            pickle.dump(self.post_ids, f)
+        root = _snapshot_root(filepath)
+        version = str(time.time_ns())
+        staging = os.path.join(root, version + '.tmp')
+        os.makedirs(staging)
+        faiss.write_index(self.index, os.path.join(staging, 'index.bin'))
+        np.save(os.path.join(staging, 'ids.npy'), self.post_ids, allow_pickle=False)
+        keys, key_ids = _sorted_keys(self.post_ids, 0)
+        np.save(os.path.join(staging, 'keys.npy'), keys, allow_pickle=False)
+        np.save(os.path.join(staging, 'key_ids.npy'), key_ids, allow_pickle=False)
+        with open(os.path.join(staging, 'built_at'), 'w') as f:
+            f.write(repr(self.built_at if self.built_at is not None else time.time()))
+        if delta_log is not None and os.path.exists(delta_log):
+            shutil.copyfile(delta_log, os.path.join(staging, 'delta.pkl'))
+        else:
+            open(os.path.join(staging, 'delta.pkl'), 'wb').close()
+        os.rename(staging, os.path.join(root, version))
 
-    def load_index(self, filepath=FAISS_INDEX_PATH):
-        """Load index from disk"""
+        manifest = os.path.join(root, 'CURRENT')
+        with open(manifest + '.tmp', 'w') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + '.tmp', manifest)
+        _prune_snapshots(root, version)
+
+        self.filepath = filepath
+        self._version = version
+        self._delta_ops = 0
+        self._delta_offset = 0
+
+    def load_index(self, filepath=FAISS_INDEX_PATH, mmap=FAISS_MMAP):
+        """Load the current snapshot (memory-mapped if mmap), then replay its delta log"""
 
         logger.info(f"🔍 Loading FAISS index from {filepath}")
-        self.index = faiss.read_index(filepath)
+        if _current_version(filepath) is None:
+            self._upgrade_legacy_snapshot(filepath)
+        replayed = self._load_snapshot(filepath, mmap)
+
+        if len(self) and self.built_type != self._target_type(len(self)):
+            if self._lossy():
+                logger.warning(
+                    f"⚠️ Keeping the ivf_pq FAISS snapshot instead of converting it to "
+                    f"{self._target_type(len(self))}: rebuild it from the post embeddings"
+                )
+            else:
+                self._convert_snapshot(filepath)
+                replayed = self._load_snapshot(filepath, mmap)
+
+        logger.info(
+            f"✅ FAISS index loaded. #posts = {len(self)} ({replayed} delta ops replayed"
+            f"{', memory-mapped' if self._mmapped else ''})"
+        )
+
+    def _load_snapshot(self, filepath, mmap):
+        """Read the version named by the manifest and replay its delta log. Returns #records replayed."""
+
+        # shared lock: no snapshot is pruned while its files are being opened
+        with _snapshot_lock(filepath, shared=True):
+            version = _current_version(filepath)
+            snapshot = os.path.join(_snapshot_root(filepath), version)
+            if mmap:
+                self.index = faiss.read_index(
+                    os.path.join(snapshot, 'index.bin'), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+                )
+            else:
+                self.index = faiss.read_index(os.path.join(snapshot, 'index.bin'))
+            mmap_mode = 'r' if mmap else None
+            self.post_ids = np.load(os.path.join(snapshot, 'ids.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+            if os.path.exists(os.path.join(snapshot, 'keys.npy')):
+                keys = np.load(os.path.join(snapshot, 'keys.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+                key_ids = np.load(os.path.join(snapshot, 'key_ids.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+            else:
+                keys = key_ids = None  # snapshot from before keys.npy: sorted in memory on first lookup
+            self.built_at = _read_built_at(snapshot, version)
+        self._n_live = len(key_ids) if key_ids is not None else int(np.count_nonzero(self.post_ids))
+        self._reset_keys(keys, key_ids)
+        self._mmapped = mmap
+        self._apply_search_params()
+
+        self.filepath = filepath
+        self._version = version
+        self._delta_ops = 0
+        self._delta_offset = 0
+        return self._replay_delta()
+
+    def _convert_snapshot(self, filepath):
+        """
+        Rebuild a snapshot of another index type as self.index_type and publish
+        it, once, under the exclusive snapshot lock; processes that lose the
+        race load the converted version instead of training their own copy.
+        """
+
+        self._materialize()
+        with _snapshot_lock(filepath):
+            if _current_version(filepath) != self._version:
+                return  # converted (or replaced) by another process meanwhile
+            self._replay_delta()
+            logger.info(f"🔧 Converting {self.built_type} FAISS snapshot to {self.index_type}")
+            self._rebuild_live()
+            self._publish_snapshot(filepath)
+
+    def _upgrade_legacy_snapshot(self, filepath):
+        """
+        Publish a snapshot from before versioned directories (<index> with
+        <index>_ids.npy, or a plain IndexFlatIP with <index>_ids.pkl) as the
+        first version, once, under the exclusive snapshot lock. FAISS ids stay
+        positions, so its delta log still applies and is carried over.
+        """
+
+        with _snapshot_lock(filepath):
+            if _current_version(filepath) is not None:
+                return  # another process upgraded it first
+            if not os.path.exists(filepath):
+                raise FileNotFoundError(f"No FAISS snapshot at {filepath}")
+
+            logger.info(f"🔧 Upgrading legacy FAISS snapshot {filepath}")
+            index = faiss.read_index(filepath)
+            if _index_type_of(index) == "flat" and not isinstance(index, faiss.IndexIDMap2):
+                # plain IndexFlatIP snapshot: FAISS ids are positions already
+                index = _wrap_flat(index)
+            ids_filepath = filepath.replace('.bin', '_ids.npy')
+            if os.path.exists(ids_filepath):
+                post_ids = np.load(ids_filepath, allow_pickle=False)
+            else:
+                with open(filepath.replace('.bin', '_ids.pkl'), 'rb') as f:
+                    post_ids = _ids_array(pickle.load(f))
+
+            self.index = index
+            self.post_ids = post_ids
+            # the legacy files were written right after their posts were read
+            self.built_at = os.path.getmtime(filepath)
+            self._publish_snapshot(filepath, delta_log=filepath.replace('.bin', '_delta.pkl'))
+
+    def reload_if_changed(self):
+        """Catch up with changes another process made: a new snapshot or new delta log entries."""
+
+        if self.filepath is None:
+            return
+        version = _current_version(self.filepath)
+        if version is not None and version != self._version:
+            self.load_index(self.filepath)
+            return
+        delta_path = self._delta_path()
+        if os.path.exists(delta_path) and os.path.getsize(delta_path) != self._delta_offset:
+            replayed = self._replay_delta()
+            if not self._mmapped:
+                logger.info(f"🔄 FAISS index caught up on {replayed} delta ops. #posts = {len(self)}")
+
+    def _delta_path(self):
+        return os.path.join(_snapshot_root(self.filepath), self._version, 'delta.pkl')
+
+    def _log_delta(self, op, post_ids, embeddings):
+        if self.filepath is None or self._version is None:
+            return
+        with open(self._delta_path(), 'ab') as f:
+            pickle.dump((op, post_ids, embeddings), f)
+            f.flush()
+            os.fsync(f.fileno())
+            self._delta_offset = f.tell()
+        self._delta_ops += 1
+
+    def _replay_delta(self):
+        """
+        Apply delta log records after the last read offset. Returns #records read;
+        a mapped snapshot only counts them (see publish_due).
+        """
+
+        delta_path = self._delta_path()
+        if not os.path.exists(delta_path):
+            return 0
+        if os.path.getsize(delta_path) < self._delta_offset:
+            # not the log we were reading: start over (records replay as upserts)
+            self._delta_offset = 0
+
+        replayed = 0
+        with open(delta_path, 'rb') as f:
+            f.seek(self._delta_offset)
+            while True:
+                try:
+                    op, post_ids, embeddings = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break  # end of log, or a record still being written
+                if not self._mmapped:
+                    # replayed as upserts, so a record seen twice is harmless
+                    existing = self.faiss_ids(post_ids)
+                    if (existing >= 0).any():
+                        self._apply_remove(existing[existing >= 0])
+                    if op != "remove":
+                        self._apply_add(embeddings, post_ids)
+                self._delta_offset = f.tell()
+                replayed += 1
+
+        self._delta_ops += replayed
+        return replayed
+
+
+    # ------------------------------------------------------------------
+    # Index construction / ANN parameters
+    # ------------------------------------------------------------------
+    def _new_index(self, train_vectors):
+        """Empty index of self.index_type, trained on a sample of train_vectors if it needs training."""
+
+        n, d = train_vectors.shape
+        index_type = self._target_type(n)
+        nlist = max(1, min(FAISS_IVF_NLIST or int(4 * np.sqrt(n)), n))
+        if index_type != self.index_type:
+            logger.warning(f"⚠️ {n} posts are too few to train PQ codes, using a flat index")
+
+        if index_type == "flat":
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+        if index_type == "hnsw":
+            hnsw = faiss.IndexHNSWFlat(d, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+            return faiss.IndexIDMap2(hnsw)
+
+        quantizer = faiss.IndexFlatIP(d)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            # largest sub-quantizer count <= FAISS_PQ_M that divides d
+            m = next(m for m in range(min(FAISS_PQ_M, d), 0, -1) if d % m == 0)
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, FAISS_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+
+        if n > FAISS_TRAIN_SAMPLE:
+            sample = np.random.default_rng(0).choice(n, FAISS_TRAIN_SAMPLE, replace=False)
+            train_vectors = train_vectors[np.sort(sample)]
+        index.train(np.ascontiguousarray(train_vectors, dtype='float32'))
+        # hashtable direct map: reconstruct and remove by post id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+
+    def _target_type(self, n):
+        """Index type a build over n posts ends up with: PQ codes need 2 ** FAISS_PQ_NBITS to train."""
+        if self.index_type == "ivf_pq" and n < 2 ** FAISS_PQ_NBITS:
+            return "flat"
+        return self.index_type
+
+    def _build(self, vectors, labels):
+        """New trained index holding vectors under the given FAISS ids."""
+        index = self._new_index(vectors)
+        index.add_with_ids(vectors, labels)
+        self._apply_search_params(index)
+        return index
+
+    def _inner(self, index=None):
+        index = self.index if index is None else index
+        if isinstance(index, faiss.IndexIDMap2):
+            return faiss.downcast_index(index.index)
+        return index
+
+    @property
+    def built_type(self):
+        """Type of the index actually in memory (may be flat if there was too little data to train)."""
+        return _index_type_of(self.index) if self.index is not None else None
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Tune the speed / recall trade-off at query time (IVF nprobe, HNSW efSearch)."""
+
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        self._apply_search_params()
+
+    def _apply_search_params(self, index=None):
+        inner = self._inner(index)
+        if isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = min(self.nprobe, inner.nlist)
+        elif isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = self.ef_search
+
+    def _live_vectors(self):
+        """(FAISS ids, vectors) of every live post, in id order."""
+        labels = np.flatnonzero(self.post_ids).astype('int64')
+        return labels, self.index.reconstruct_batch(labels)
+
+    def recall_at_k(self, queries=None, k=TOP_K, n_queries=FAISS_RECALL_QUERIES):
+        """
+        Recall@k of this index against exact (flat) search over the same
+        vectors, plus per-query latency of both. Queries default to a sample
+        of indexed post vectors. For ivf_pq the reference vectors are the PQ
+        reconstructions, so the figure only covers IVF/search-time loss.
+        """
+
+        labels, vectors = self._live_vectors()
+        if queries is None:
+            rows = np.random.default_rng(0).choice(len(labels), min(n_queries, len(labels)), replace=False)
+            queries = vectors[rows]
+        queries = np.array(queries, dtype='float32')
+        faiss.normalize_L2(queries)
+        k = min(k, len(labels))
+
+        exact = faiss.IndexFlatIP(vectors.shape[1])
+        exact.add(vectors)
+
+        started = time.perf_counter()
+        _, found = self.index.search(queries, k)
+        ann_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        started = time.perf_counter()
+        _, truth = exact.search(queries, k)
+        flat_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        truth = labels[truth]
+        hits = (found[:, :, None] == truth[:, None, :]).any(axis=2).sum(axis=1)
+        report = {
+            "index_type": self.built_type,
+            "k": int(k),
+            "queries": int(len(queries)),
+            "recall": float(hits.mean() / k),
+            "ann_ms_per_query": ann_ms,
+            "flat_ms_per_query": flat_ms,
+        }
+        logger.info(
+            f"📏 FAISS {report['index_type']} recall@{k} = {report['recall']:.3f} "
+            f"({ann_ms:.3f} ms vs {flat_ms:.3f} ms flat per query)"
+        )
+        return report
+
+
+def _index_type_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def _snapshot_root(filepath):
+    return filepath.replace('.bin', '_snapshots')
+
+
+def _current_version(filepath):
+    """Snapshot version named by <index>_snapshots/CURRENT, or None before the first one."""
+    try:
+        with open(os.path.join(_snapshot_root(filepath), 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _read_built_at(snapshot, version):
+    """built_at of a snapshot directory; its publish time for snapshots written before the file existed."""
+    try:
+        with open(os.path.join(snapshot, 'built_at')) as f:
+            return float(f.read())
+    except FileNotFoundError:
+        return int(version) / 1e9
+
+
+def _snapshot_lock(filepath, shared=False):
+    """flock on <index>.lock: exclusive to publish or upgrade a snapshot, shared while opening one."""
+    os.makedirs(_snapshot_root(filepath), exist_ok=True)
+    return file_lock(filepath + '.lock', shared)
+
+
+def _prune_snapshots(root, current):
+    """Drop all but the newest FAISS_SNAPSHOTS_KEPT versions and any unfinished staging dirs."""
+    names = os.listdir(root)
+    versions = sorted((name for name in names if name.isdigit()), key=int)
+    stale = [name for name in names if name.endswith('.tmp') and name != 'CURRENT.tmp']
+    stale += [name for name in versions[:-FAISS_SNAPSHOTS_KEPT] if name != current]
+    for name in stale:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _ids_array(post_ids):
+    """Post ids as a flat bytes array; None (removed) becomes b""."""
+    if len(post_ids) == 0:
+        return np.zeros(0, dtype='S24')
+    return np.array([b"" if post_id is None else str(post_id).encode() for post_id in post_ids], dtype=bytes)
+
+
+def _sorted_keys(post_ids, start):
+    """(live post ids of post_ids[start:] sorted, their FAISS ids as int64) for searchsorted lookups."""
+    tail = np.asarray(post_ids[start:])
+    live = np.flatnonzero(tail != b"")
+    keys = tail[live]
+    order = np.argsort(keys, kind='stable')
+    return keys[order], (live[order] + start).astype('int64')
 
-        ids_filepath = filepath.replace('.bin', '_ids.pkl')
-        with open(ids_filepath, 'rb') as f:
-            self.post_ids = pickle.load(f)
 
-        logger.info(f"✅ FAISS index loaded. #posts = {len(self.post_ids)}")
+def _wrap_flat(flat_index):
+    """IndexIDMap2 holding a flat index's vectors under their positions as ids."""
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(flat_index.d))
+    index.add_with_ids(flat_index.reconstruct_n(0, flat_index.ntotal),
+                       np.arange(flat_index.ntotal, dtype='int64'))
+    return index
 
 
 _indexer = None
@@ -0,0 +1,217 @@
+# feature_tables.py
+
+import logging
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from id_interner import IdInterner
+
+logger = logging.getLogger(__name__)
+
+# only these fields are pulled from Mongo (bodies/media are never needed here)
+POST_FEATURE_FIELDS = ["community_id", "score", "status", "createdAt"]
+USER_PROFILE_FIELDS = ["num_posts", "num_comments", "communities_followed"]
+
+
+def _grow(array: np.ndarray, size: int, fill=0) -> np.ndarray:
+    """Copy of a 1-D array extended to `size` with `fill`."""
+    if array.size >= size:
+        return array.copy()
+    grown = np.full(size, fill, dtype=array.dtype)
+    grown[: array.size] = array
+    return grown
+
+
+def _int_column(df: pd.DataFrame, column: str) -> np.ndarray:
+    """Column as int32, treating missing / non-numeric values as 0."""
+    if column not in df.columns:
+        return np.zeros(len(df), dtype=np.int32)
+    return pd.to_numeric(df[column], errors="coerce").fillna(0).to_numpy().astype(np.int32)
+
+
+class PostFeatureTable:
+    """
+    Per-post features as contiguous arrays indexed by interned post id
+    (community index, score, active flag, creation time as epoch seconds with
+    NaN = unknown), so looking a post up by id is a dict hit plus array
+    indexing instead of a DataFrame scan. `generation` goes up with every
+    upsert that writes posts, so derived data can be cached against it.
+    """
+
+    def __init__(self, posts: IdInterner, communities: IdInterner):
+        self.posts = posts
+        self.communities = communities
+        self.known = np.zeros(0, dtype=bool)
+        self.community_idx = np.zeros(0, dtype=np.int32)
+        self.score = np.zeros(0, dtype=np.float64)
+        self.active = np.zeros(0, dtype=bool)
+        self.created_at = np.zeros(0, dtype=np.float64)
+        self.generation = 0
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def upsert(self, posts_df: pd.DataFrame) -> int:
+        """
+        Insert or replace the posts in posts_df (post_id, community_id, score,
+        status, createdAt). Returns the number of posts written.
+        """
+        if posts_df is None or posts_df.empty:
+            return 0
+
+        rows = self.posts.intern_many(posts_df["post_id"].astype(str).tolist())
+        # no community (column absent, None or NaN) is -1, never an interned "None"
+        community_idx = np.full(len(rows), -1, dtype=np.int32)
+        if "community_id" in posts_df.columns:
+            has_community = posts_df["community_id"].notna().to_numpy()
+            community_idx[has_community] = self.communities.intern_many(
+                posts_df["community_id"][has_community].astype(str).tolist()
+            )
+        # a missing score column counts as 0; a post without a score keeps NaN (see popularity)
+        if "score" in posts_df.columns:
+            score = pd.to_numeric(posts_df["score"], errors="coerce").to_numpy(dtype=np.float64)
+        else:
+            score = np.zeros(len(rows))
+        # only rank active posts if status exists
+        if "status" in posts_df.columns:
+            active = posts_df["status"].to_numpy() == "active"
+        else:
+            active = np.ones(len(rows), dtype=bool)
+        if "createdAt" in posts_df.columns:
+            created = pd.to_datetime(posts_df["createdAt"], errors="coerce", utc=True)
+            created_at = ((created - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+        else:
+            created_at = np.full(len(rows), np.nan)
+
+        n_posts = len(self.posts)
+        known = _grow(self.known, n_posts, False)
+        community_arr = _grow(self.community_idx, n_posts, -1)
+        score_arr = _grow(self.score, n_posts)
+        active_arr = _grow(self.active, n_posts, False)
+        created_arr = _grow(self.created_at, n_posts, np.nan)
+        known[rows] = True
+        community_arr[rows] = community_idx
+        score_arr[rows] = score
+        active_arr[rows] = active
+        created_arr[rows] = created_at
+
+        self.community_idx = community_arr
+        self.score = score_arr
+        self.active = active_arr
+        self.created_at = created_arr
+        self.known = known
+        self.generation += 1
+        return int(rows.size)
+
+    def row(self, post_id: str) -> int:
+        """Row of a known post, or -1."""
+        idx = self.posts.lookup(post_id)
+        if idx < 0 or idx >= self.known.size or not self.known[idx]:
+            return -1
+        return idx
+
+    def popularity(self, rows=None) -> np.ndarray:
+        """
+        min(1, score / 100) for rows (all rows if None). A NaN score gives 1.0,
+        as the original per-post min(1.0, post_score / 100.0) did.
+        """
+        score = self.score if rows is None else self.score[rows]
+        return np.where(np.isnan(score), 1.0, np.minimum(1.0, score / 100.0))
+
+    def active_rows(self) -> np.ndarray:
+        """Rows of every known, active post in index order."""
+        return np.flatnonzero(self.known & self.active).astype(np.int32)
+
+
+class UserProfileTable:
+    """
+    User profiles stored as struct-of-arrays indexed by interned user id:
+    num_posts / num_comments / total_votes as int32 arrays and followed
+    communities as a users x communities CSR of interned community ids.
+    """
+
+    def __init__(self, users: IdInterner, communities: IdInterner):
+        self.users = users
+        self.communities = communities
+        self.known = np.zeros(0, dtype=bool)
+        self.num_posts = np.zeros(0, dtype=np.int32)
+        self.num_comments = np.zeros(0, dtype=np.int32)
+        self.total_votes = np.zeros(0, dtype=np.int32)
+        self.followed = sp.csr_matrix((0, 0), dtype=np.int8)
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def upsert(self, users_df: pd.DataFrame) -> int:
+        """
+        Insert or replace the profiles in users_df (user_id, num_posts,
+        num_comments, communities_followed). Returns the number of profiles written.
+        """
+        if users_df is None or users_df.empty:
+            return 0
+
+        user_ids = users_df["user_id"].astype(str)
+        users_df = users_df[(user_ids != "") & (user_ids != "None")]
+        rows = self.users.intern_many(users_df["user_id"].astype(str).tolist())
+
+        num_posts = _int_column(users_df, "num_posts")
+        num_comments = _int_column(users_df, "num_comments")
+
+        followed_lists = (
+            users_df["communities_followed"].tolist()
+            if "communities_followed" in users_df.columns
+            else [None] * len(users_df)
+        )
+        counts = np.zeros(len(rows), dtype=np.int64)
+        community_idx = []
+        for i, communities in enumerate(followed_lists):
+            if isinstance(communities, (list, tuple, np.ndarray)):
+                idx = self.communities.intern_many(communities)
+                counts[i] = idx.size
+                community_idx.append(idx)
+        community_idx = np.concatenate(community_idx) if community_idx else np.empty(0, dtype=np.int32)
+
+        n_users, n_communities = len(self.users), len(self.communities)
+
+        # build everything first, then swap in
+        known = _grow(self.known, n_users, False)
+        posts_arr = _grow(self.num_posts, n_users)
+        comments_arr = _grow(self.num_comments, n_users)
+        known[rows] = True
+        posts_arr[rows] = num_posts
+        comments_arr[rows] = num_comments
+
+        followed = self.followed.copy()
+        followed.resize((n_users, n_communities))
+        keep = np.ones(n_users, dtype=np.int8)
+        keep[rows] = 0
+        followed = sp.diags(keep, dtype=np.int8).dot(followed).tocsr()
+        followed.eliminate_zeros()
+        delta = sp.csr_matrix(
+            (np.ones(community_idx.size, dtype=np.int8), (np.repeat(rows, counts), community_idx)),
+            shape=(n_users, n_communities),
+        )
+        followed = (followed + delta).tocsr()
+        followed.data[:] = 1  # a community listed twice is still followed once
+
+        self.followed = followed
+        self.num_posts = posts_arr
+        self.num_comments = comments_arr
+        self.total_votes = posts_arr + comments_arr
+        self.known = known
+        return int(rows.size)
+
+    def row(self, user_id: str) -> int:
+        """Row of a user with a profile, or -1."""
+        idx = self.users.lookup(user_id)
+        if idx < 0 or idx >= self.known.size or not self.known[idx]:
+            return -1
+        return idx
+
+    def followed_communities(self, row: int) -> np.ndarray:
+        """Interned community ids followed by the user at `row`."""
+        if row < 0 or row >= self.followed.shape[0]:
+            return np.empty(0, dtype=np.int32)
+        return self.followed.indices[self.followed.indptr[row]:self.followed.indptr[row + 1]]
@@ -0,0 +1,12 @@
+# file_lock.py
+
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """flock on the file at `path` (created if missing): exclusive, or shared if `shared`."""
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield  # released when the file closes
@@ -0,0 +1,65 @@
+# id_interner.py
+
+from typing import Dict, List
+
+import numpy as np
+
+
+class IdInterner:
+    """
+    Maps ObjectId strings to dense int32 indices (and back), so the rest of the
+    recommender can store ids as small integers and do lookups by array index.
+    Indices are assigned in first-seen order and never change; ids are only
+    ever appended, so arrays sized from an older len() stay valid.
+    """
+
+    def __init__(self, ids=()):
+        self._index: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._ids_array = np.empty(0, dtype=object)
+        self.intern_many(ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id_) -> bool:
+        return str(id_) in self._index
+
+    def intern(self, id_) -> int:
+        """Index of id_, assigning the next free one if it is new."""
+        key = str(id_)
+        idx = self._index.get(key)
+        if idx is None:
+            idx = len(self._ids)
+            self._ids.append(key)
+            self._index[key] = idx
+        return idx
+
+    def intern_many(self, ids) -> np.ndarray:
+        """int32 indices for ids, assigning new ones as needed."""
+        out = np.empty(len(ids), dtype=np.int32)
+        for i, id_ in enumerate(ids):
+            out[i] = self.intern(id_)
+        return out
+
+    def lookup(self, id_) -> int:
+        """Index of id_, or -1 if it has never been interned."""
+        return self._index.get(str(id_), -1)
+
+    def lookup_many(self, ids) -> np.ndarray:
+        """int32 indices for ids, -1 for unknown ones."""
+        index = self._index
+        return np.fromiter((index.get(str(id_), -1) for id_ in ids), dtype=np.int32, count=len(ids))
+
+    @property
+    def ids(self) -> np.ndarray:
+        """All interned ids as an object array, position = index."""
+        if len(self._ids_array) != len(self._ids):
+            self._ids_array = np.asarray(self._ids, dtype=object)
+        return self._ids_array
+
+    def id_of(self, idx: int) -> str:
+        return self._ids[idx]
+
+    def ids_of(self, idxs) -> np.ndarray:
+        return self.ids[np.asarray(idxs, dtype=np.int64)]
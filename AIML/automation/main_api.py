@@ -1,35 +1,123 @@
 # main_api.py
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
+from celery.result import AsyncResult
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from config import (
+    HEURISTICS_REFRESH_INTERVAL_SECONDS,
+    API_RANKING_WORKERS,
+    REFRESH_LOCK_SECONDS,
+)
 from tasks import refresh_single_user_recommendations
 from topk_hybrid_advanced import get_recommender
+from upstash_client import upstash_client, is_stale
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
 recommender = None
+refresh_task = None
+# cold-start ranking runs here so a slow ranking never blocks the event loop
+ranking_pool = None
+# user_id -> the one in-flight miss resolution that concurrent requests share
+inflight_misses: Dict[str, asyncio.Future] = {}
+
+
+async def refresh_heuristics_periodically():
+    """Keep posts/profiles/votes warm by patching in changes every interval."""
+    while True:
+        await asyncio.sleep(HEURISTICS_REFRESH_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(recommender.refresh_heuristics_data)
+        except Exception:
+            logger.exception("Heuristics refresh failed; will retry next interval")
+
+
+async def queue_refresh(user_id: str) -> Optional[AsyncResult]:
+    """
+    Queue a Celery refresh unless one is already queued for this user (across all API workers).
+    Returns the queued task, or None if one was already queued.
+    """
+    lock_token = await upstash_client.aacquire_refresh_lock(user_id, REFRESH_LOCK_SECONDS)
+    if lock_token is None:
+        logger.info(f"Refresh already queued for {user_id}, not enqueueing another")
+        return None
+    return await asyncio.to_thread(
+        refresh_single_user_recommendations.apply_async, args=[user_id, lock_token], queue="recommendations"
+    )
+
+
+async def resolve_miss(user_id: str) -> Dict[str, Any]:
+    """Cold-start ranking in the pool, else queue one Celery refresh."""
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        ranking_pool, recommender.get_uncached_recommendations, user_id
+    )
+    if result.get("recommendations") is None:
+        logger.info(f"Cache miss & not cold-start for {user_id} -> enqueueing Celery task")
+        await queue_refresh(user_id)
+    return result
+
+
+async def coalesced_miss(user_id: str) -> Dict[str, Any]:
+    """Single-flight: concurrent misses for one user await the same resolve_miss."""
+    future = inflight_misses.get(user_id)
+    if future is None:
+        future = asyncio.ensure_future(resolve_miss(user_id))
+        inflight_misses[user_id] = future
+        future.add_done_callback(lambda _: inflight_misses.pop(user_id, None))
+    else:
+        logger.info(f"Joining in-flight miss for {user_id}")
+    # shielded so one client disconnecting does not cancel the others' result
+    return await asyncio.shield(future)
 
 
 @app.on_event("startup")
 async def startup_event():
-    global recommender
+    global recommender, refresh_task, ranking_pool
     recommender = get_recommender()
     logger.info("Recommender initialized on startup")
 
+    ranking_pool = ThreadPoolExecutor(max_workers=API_RANKING_WORKERS, thread_name_prefix="ranking")
+
+    if HEURISTICS_REFRESH_INTERVAL_SECONDS > 0:
+        refresh_task = asyncio.create_task(refresh_heuristics_periodically())
+        logger.info(f"Heuristics refresh scheduled every {HEURISTICS_REFRESH_INTERVAL_SECONDS}s")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if refresh_task is not None:
+        refresh_task.cancel()
+    if ranking_pool is not None:
+        ranking_pool.shutdown(wait=False, cancel_futures=True)
+
 
 @app.get("/recommendations/{user_id}")
 async def get_recommendations(user_id: str, background_tasks: BackgroundTasks):
     """
     Flow:
-      1) If cache hit -> return cache
-      2) If cold-start -> compute heuristics + collaborative synchronously -> return + cache
-      3) Else -> enqueue Celery on-demand refresh and return 202 'generating'
+      1) If cache hit (async Upstash read) -> return cache; past its soft TTL it is
+         returned as 'stale' and one Celery refresh is queued after the response
+      2) If cold-start -> compute heuristics + collaborative in the ranking pool -> return + cache
+      3) Else (no entry: never cached or past the hard TTL) -> enqueue Celery on-demand
+         refresh and return 202 'generating'
+    Concurrent misses for the same user share one computation and at most one queued task.
     """
     try:
-        result = recommender.get_hybrid_recommendations(user_id)
+        entry = await upstash_client.aget_user_entry(user_id)
+        if entry and entry["recommendations"]:
+            result = {"recommendations": entry["recommendations"], "source": "cache", "strategy": "cache"}
+            if is_stale(user_id, entry):
+                result["source"] = "stale"
+                background_tasks.add_task(queue_refresh, user_id)
+        else:
+            result = await coalesced_miss(user_id)
 
-        # If recommendations present (cache or cold_start) -> return
+        # If recommendations present (cache, stale or cold_start) -> return
         if result.get("recommendations") is not None:
             logger.info(f"Returning {result.get('source')} recommendations for {user_id}")
             return JSONResponse({
@@ -39,10 +127,7 @@ async def get_recommendations(user_id: str, background_tasks: BackgroundTasks):
                 "strategy": result.get("strategy"),
             })
 
-        # Otherwise: cache miss and not cold-start -> enqueue celery
-        logger.info(f"Cache miss & not cold-start for {user_id} -> enqueueing Celery task")
-        refresh_single_user_recommendations.apply_async(args=[user_id], queue="recommendations")
-
+        # Otherwise: cache miss and not cold-start -> celery refresh queued (by us or an earlier miss)
         return JSONResponse(
             status_code=202,
             content={
@@ -61,8 +146,16 @@ async def get_recommendations(user_id: str, background_tasks: BackgroundTasks):
 @app.post("/recommendations/refresh/{user_id}")
 async def manual_refresh(user_id: str):
     try:
-        result = refresh_single_user_recommendations.apply_async(args=[user_id], queue="recommendations")
+        result = await queue_refresh(user_id)
+        if result is None:
+            return {"status": "refresh_already_queued", "user_id": user_id}
         return {"status": "refresh_queued", "user_id": user_id, "task_id": result.id}
     except Exception as e:
         logger.exception("Failed to enqueue refresh task")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters and occupancy of this worker's in-process recommendation cache."""
+    return upstash_client.local_cache.stats()
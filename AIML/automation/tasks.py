@@ -1,118 +1,203 @@
 import logging
 import json
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+from celery import chord, group
+from celery.schedules import crontab
 
 from celery_app import app  # ⬅️ use the configured Celery app instead of shared_task
 
-from database import get_all_users, get_user_data
+from database import get_mongo_connection, get_user_data, id_range_filter
 from model_loader import get_recommendation_model
 from embedding_generator import get_embedding_generator
 from faiss_indexer import get_faiss_indexer
+from user_embedding_store import get_user_embedding_store
+from topk_hybrid_advanced import get_recommender, profile_text, seen_posts, nightly_checkpoint_key
 from upstash_client import upstash_client
-from config import TOP_K, CACHE_EXPIRY_HOURS
+from config import (
+    TOP_K,
+    CACHE_EXPIRY_HOURS,
+    CACHE_STALE_HOURS,
+    CACHE_WRITE_BATCH_SIZE,
+    NIGHTLY_SHARDS,
+    PREWARM_ACTIVITY_DAYS,
+    PREWARM_MAX_USERS,
+    PREWARM_AHEAD_SECONDS,
+    PREWARM_BATCH_SIZE,
+    PREWARM_BATCH_PAUSE_SECONDS,
+    HYBRID_CANDIDATES,
+    POST_INDEX_UPDATE_MINUTES,
+    POST_INDEX_LOCK_SECONDS,
+)
 
 logger = logging.getLogger(__name__)
 
+# post fields read by EmbeddingGenerator.generate_post_embeddings, plus status and the watermark field
+POST_INDEX_FIELDS = ["caption", "body", "title", "status", "updatedAt"]
+# Redis key holding the updatedAt watermark of the last post index update
+POST_INDEX_WATERMARK_KEY = "faiss:posts_updated_until"
+# Redis key of the lock held for a whole post index update
+POST_INDEX_LOCK_KEY = "faiss:posts_update_lock"
+# re-read posts updated shortly before the watermark (clock skew between app servers)
+POST_INDEX_WATERMARK_OVERLAP = timedelta(seconds=60)
+
+
+def _generate_for_users(filter_query=None, checkpoint_key=None, **kwargs) -> dict:
+    """
+    Generate and cache recommendations for the users matching filter_query
+    with this worker's recommender (see AdvancedTopKRecommender.generate_for_users).
+    Returns users_processed / users_failed.
+    """
+    stats = get_recommender().generate_for_users(filter_query, checkpoint_key=checkpoint_key, **kwargs)
+    return {"users_processed": stats["successful"], "users_failed": stats["failed"]}
+
 
 @app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.generate_recommendations_task")
-def generate_recommendations_task(self):
+def generate_recommendations_task(self, n_shards: int = NIGHTLY_SHARDS):
     """
     Nightly batch: Generate and directly cache recommendations in Upstash for all users.
+
+    With n_shards > 1 the user _id space is split into contiguous ranges and
+    one generate_recommendations_shard subtask is queued per range (a chord);
+    aggregate_nightly_shards sums their stats. Each worker process loads the
+    FAISS index and SBERT model once and reuses them for every shard it runs.
     """
     try:
-        logger.info("🌙 Starting nightly batch recommendation generation...")
-        recommendation_model = get_recommendation_model()
-        embedding_generator = get_embedding_generator()
-        faiss_indexer = get_faiss_indexer()
+        if n_shards <= 1:
+            logger.info("🌙 Starting nightly batch recommendation generation...")
+            stats = _generate_for_users(checkpoint_key=nightly_checkpoint_key("tasks"))
+            logger.info(f"✅ Nightly batch complete for {stats['users_processed']} users")
+            return {"status": "success", **stats}
 
-        users = get_all_users()
-        logger.info(f"Processing {len(users)} users...")
+        boundaries = get_mongo_connection().get_id_boundaries("users", n_shards)
+        bounds = [None] + boundaries + [None]
+        shards = [
+            generate_recommendations_shard.s(shard, bounds[shard], bounds[shard + 1])
+            for shard in range(len(bounds) - 1)
+        ]
+        logger.info(f"🌙 Dispatching nightly batch as {len(shards)} shards...")
+        result = chord(group(shards))(aggregate_nightly_shards.s())
+        return {"status": "dispatched", "shards": len(shards), "task_id": result.id}
+
+    except Exception as exc:
+        logger.error(f"❌ Task failed: {str(exc)}")
+        raise self.retry(exc=exc, countdown=60)
 
-        user_recommendations = {}
 
-        for idx, user in enumerate(users):
-            user_id = str(user.get("user_id"))
+@app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.generate_recommendations_shard")
+def generate_recommendations_shard(self, shard: int, lower_id=None, upper_id=None):
+    """
+    One shard of the nightly batch: users with lower_id <= _id < upper_id
+    (None = unbounded).
+    """
+    try:
+        logger.info(f"🌙 Shard {shard}: generating recommendations...")
+        stats = _generate_for_users(
+            id_range_filter(lower_id, upper_id),
+            checkpoint_key=nightly_checkpoint_key(f"tasks:shard:{lower_id or 'start'}-{upper_id or 'end'}"),
+        )
+        logger.info(f"✅ Shard {shard} complete for {stats['users_processed']} users")
+        return {"shard": shard, "status": "success", **stats}
 
-            profile_text = (
-                str(user.get("username", "")) + " "
-                + str(user.get("bio", "")) + " "
-                + str(user.get("interests", ""))
-            )
+    except Exception as exc:
+        logger.error(f"❌ Shard {shard} failed: {str(exc)}")
+        raise self.retry(exc=exc, countdown=60)
 
-            embedding = embedding_generator.model.encode(
-                [profile_text], convert_to_numpy=True
-            )
 
-            distances, item_ids = faiss_indexer.search(embedding[0], k=TOP_K)
+@app.task(name="tasks.aggregate_nightly_shards")
+def aggregate_nightly_shards(shard_results):
+    """Chord callback: combine per-shard stats into the nightly result."""
+    users_processed = sum(r.get("users_processed", 0) for r in shard_results)
+    users_failed = sum(r.get("users_failed", 0) for r in shard_results)
+    logger.info(
+        f"✅ Nightly batch complete for {users_processed} users "
+        f"({users_failed} failed) across {len(shard_results)} shards"
+    )
+    return {
+        "status": "success",
+        "users_processed": users_processed,
+        "users_failed": users_failed,
+        "shards": sorted(shard_results, key=lambda r: r.get("shard", 0)),
+    }
 
-            recommendations = [
-                {
-                    "item_id": str(item_id),
-                    "score": float(1 / (1 + distance)),
-                    "rank": rank + 1,
-                }
-                for rank, (distance, item_id) in enumerate(
-                    zip(distances[0], item_ids[0])
-                )
-            ]
 
-            # Store in Upstash Redis, per-user
-            upstash_client.store_user_recommendations(
-                user_id, recommendations, expiry_hours=CACHE_EXPIRY_HOURS
-            )
-            user_recommendations[user_id] = recommendations
+@app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.prewarm_recommendations")
+def prewarm_recommendations(self):
+    """
+    Periodic: refresh the cache ahead of expiry for the most recently active
+    users (up to PREWARM_MAX_USERS active in the last PREWARM_ACTIVITY_DAYS)
+    whose entry is missing or goes stale within PREWARM_AHEAD_SECONDS, in
+    throttled batches so the refresh does not itself become a load spike.
+    """
+    try:
+        since = datetime.now(timezone.utc) - timedelta(days=PREWARM_ACTIVITY_DAYS)
+        active = get_mongo_connection().get_recently_active_user_ids(since, PREWARM_MAX_USERS)
+        ttls = []
+        for start in range(0, len(active), CACHE_WRITE_BATCH_SIZE):
+            ttls.extend(upstash_client.get_ttls(active[start:start + CACHE_WRITE_BATCH_SIZE]))
+        # keys live exactly CACHE_STALE_HOURS past their (jittered) soft deadline, so
+        # ttl - stale_seconds is the time left until it; -1 = no expiry: nothing to get ahead of
+        stale_seconds = CACHE_STALE_HOURS * 3600
+        due = [
+            user_id for user_id, ttl in zip(active, ttls)
+            if ttl == -2 or (ttl != -1 and ttl - stale_seconds < PREWARM_AHEAD_SECONDS)
+        ]
 
-            if (idx + 1) % 100 == 0:
-                logger.info(f"✓ Done for {idx + 1}/{len(users)} users")
+        logger.info(f"🔥 Pre-warming {len(due)} of {len(active)} active users...")
+        if not due:
+            return {"status": "success", "active_users": len(active), "users_processed": 0, "users_failed": 0}
 
-        logger.info(f"✅ Nightly batch complete for {len(users)} users")
-        return {
-            "status": "success",
-            "users_processed": len(users),
-        }
+        stats = _generate_for_users(
+            {"_id": {"$in": [ObjectId(user_id) for user_id in due]}},
+            batch_size=PREWARM_BATCH_SIZE,
+            pause_seconds=PREWARM_BATCH_PAUSE_SECONDS,
+        )
+        logger.info(f"✅ Pre-warmed {stats['users_processed']} users ({stats['users_failed']} failed)")
+        return {"status": "success", "active_users": len(active), **stats}
 
     except Exception as exc:
-        logger.error(f"❌ Task failed: {str(exc)}")
+        logger.error(f"❌ Pre-warm failed: {str(exc)}")
         raise self.retry(exc=exc, countdown=60)
 
 
 @app.task(name="tasks.refresh_single_user_recommendations")
-def refresh_single_user_recommendations(user_id: str):
+def refresh_single_user_recommendations(user_id: str, lock_token: Optional[str] = None):
     """
     On-demand: Generate and cache recommendations in Upstash for a single user.
+    lock_token is the refresh lock token of the API call that queued it (see main_api.queue_refresh).
     """
     try:
         logger.info(f"🔄 Refreshing recommendations for user {user_id}...")
         recommendation_model = get_recommendation_model()
         embedding_generator = get_embedding_generator()
         faiss_indexer = get_faiss_indexer()
+        faiss_indexer.reload_if_changed()
 
         user = get_user_data(user_id)
         if not user:
             logger.warning(f"No user found with ID {user_id}")
             return {"status": "not_found", "user_id": user_id}
 
-        profile_text = (
-            str(user.get("username", "")) + " "
-            + str(user.get("bio", "")) + " "
-            + str(user.get("interests", ""))
-        )
+        text = profile_text(user.get("username"), user.get("bio"), user.get("interests"))
 
-        embedding = embedding_generator.model.encode(
-            [profile_text], convert_to_numpy=True
-        )
+        embedding_store = get_user_embedding_store()
+        embedding = embedding_store.encode([user_id], [text], embedding_generator.model)
+        embedding_store.flush()
 
-        distances, item_ids = faiss_indexer.search(embedding[0], k=TOP_K)
-
-        recommendations = [
-            {
-                "item_id": str(item_id),
-                "score": float(1 / (1 + distance)),
-                "rank": rank + 1,
-            }
-            for rank, (distance, item_id) in enumerate(
-                zip(distances[0], item_ids[0])
-            )
-        ]
+        # skip posts the user already voted on and posts that are not active
+        recommender = get_recommender()
+        recommender.refresh_heuristics_if_stale()
+        similarities, candidate_ids = faiss_indexer.search_batch(
+            embedding, k=HYBRID_CANDIDATES,
+            exclude=seen_posts(get_mongo_connection(), [user_id]),
+            allowed=recommender.allowed_post_mask(faiss_indexer),
+        )
+        recommendations = recommender.rerank_candidates([user_id], similarities, candidate_ids, TOP_K)[0]
 
         # Store in Upstash Redis for this user
         upstash_client.store_user_recommendations(
@@ -128,3 +213,150 @@ def refresh_single_user_recommendations(user_id: str):
     except Exception as e:
         logger.error(f"Error refreshing for user {user_id}: {str(e)}")
         return {"status": "failed", "error": str(e)}
+
+    finally:
+        # let the API queue the next refresh for this user; without a token the lock
+        # is not ours to release and expires on its own
+        if lock_token is not None:
+            upstash_client.release_refresh_lock(user_id, lock_token)
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.update_post_index")
+def update_post_index(self):
+    """
+    Periodic: bring the FAISS post index up to date with posts changed since
+    the last run. Active posts are (re-)embedded and upserted, posts that are
+    no longer active are removed, and the delta log is compacted into a new
+    snapshot once it grows large enough. With FAISS_MMAP changes are only
+    logged, and a snapshot is published at most every FAISS_PUBLISH_MINUTES
+    (see FAISSIndexer.publish_due), since each publish rewrites the index.
+
+    Posts are read in (updatedAt, _id) order and the watermark moves after
+    every chunk (its changes are in the delta log by then), so a run cut
+    short by the time limit resumes where it stopped. Without a watermark
+    the window starts at the snapshot's built_at. Runs never overlap: one
+    that finds the update lock taken is skipped.
+    """
+    lock_token = upstash_client.acquire_lock(POST_INDEX_LOCK_KEY, POST_INDEX_LOCK_SECONDS)
+    if lock_token is None:
+        logger.info("⏭️ Post index update already running, skipping this run")
+        return {"status": "skipped"}
+
+    try:
+        faiss_indexer = get_faiss_indexer()
+        faiss_indexer.reload_if_changed()
+
+        watermark = upstash_client.sync_redis.get(POST_INDEX_WATERMARK_KEY)
+        if watermark:
+            covered_until = datetime.fromisoformat(watermark)
+        else:
+            # first run (or lost watermark): the snapshot already holds every post up to its build
+            covered_until = datetime.fromtimestamp(faiss_indexer.built_at, timezone.utc)
+        filter_query = {"updatedAt": {"$gte": covered_until - POST_INDEX_WATERMARK_OVERLAP}}
+
+        # streamed from the cursor, which raises on a failed read (get_posts would
+        # return an empty frame and the watermark would skip the window)
+        upserted = removed = 0
+        embedding_generator = get_embedding_generator()
+        chunks = get_mongo_connection().iter_posts(
+            filter_query, POST_INDEX_FIELDS, sort=[("updatedAt", 1), ("_id", 1)]
+        )
+        for chunk in chunks:
+            posts_df = pd.DataFrame(chunk)
+            if "status" in posts_df.columns:
+                active = (posts_df["status"] == "active").to_numpy()
+            else:
+                active = np.ones(len(posts_df), dtype=bool)
+            removed += faiss_indexer.remove_posts(posts_df.loc[~active, "post_id"].astype(str))
+
+            active_posts = posts_df[active]
+            if not active_posts.empty:
+                embeddings, post_ids = embedding_generator.generate_post_embeddings(active_posts)
+                upserted += faiss_indexer.upsert_posts(embeddings, post_ids)
+
+            # sorted by updatedAt, so the last post is the newest this chunk covers
+            covered_until = _as_utc(chunk["updatedAt"][-1])
+            upstash_client.sync_redis.set(POST_INDEX_WATERMARK_KEY, covered_until.isoformat())
+
+        compacted = faiss_indexer.needs_compaction()
+        published = compacted or faiss_indexer.publish_due()
+        if published:
+            faiss_indexer.built_at = covered_until.timestamp()
+        recall = None
+        if compacted:
+            faiss_indexer.compact()
+            if faiss_indexer.built_type in ("ivf_flat", "hnsw"):
+                # rebuilt (ivf_pq keeps its codes): check the approximate index still finds the true top-K
+                recall = faiss_indexer.recall_at_k()
+        elif published:
+            faiss_indexer.save_index(faiss_indexer.filepath)
+
+        logger.info(f"✅ Post index updated: {upserted} upserted, {removed} removed, #posts = {len(faiss_indexer)}")
+        return {
+            "status": "success",
+            "upserted": upserted,
+            "removed": removed,
+            "compacted": compacted,
+            "published": published,
+            "recall": recall,
+            "posts_indexed": len(faiss_indexer),
+        }
+
+    except Exception as exc:
+        logger.error(f"❌ Post index update failed: {str(exc)}")
+        raise self.retry(exc=exc, countdown=60)
+
+    finally:
+        upstash_client.release_lock(POST_INDEX_LOCK_KEY, lock_token)
+
+
+def _as_utc(value: datetime) -> datetime:
+    """pymongo returns naive UTC datetimes; make them aware so .timestamp() does not assume local time."""
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.publish_trending")
+def publish_trending(self):
+    """
+    Periodic: publish the time-decayed global and per-community trending lists
+    to Redis (trending:global, trending:community:<id>) so other services read
+    the same lists the cold-start path ranks from. Single writer; the lists are
+    rebuilt with the worker's heuristics refresh.
+    """
+    try:
+        recommender = get_recommender()
+        recommender.refresh_heuristics_if_stale()
+        if recommender.trending is None:
+            logger.warning("⚠️ Trending lists not built yet, nothing to publish")
+            return {"status": "skipped", "lists": 0}
+
+        published = recommender.trending.publish(upstash_client.sync_redis)
+        logger.info(f"✅ Published {published} trending lists")
+        return {"status": "success", "lists": published}
+
+    except Exception as exc:
+        logger.error(f"❌ Trending publish failed: {str(exc)}")
+        raise self.retry(exc=exc, countdown=60)
+
+
+# ============================================================================
+# Periodic schedule: set on the worker app so beat only sends tasks the workers register
+# ============================================================================
+app.conf.beat_schedule = {
+    **(app.conf.beat_schedule or {}),
+    # embed new / changed posts into FAISS; compacts the delta log past FAISS_COMPACT_* thresholds
+    'update-post-index': {
+        'task': 'tasks.update_post_index',
+        'schedule': crontab(minute=f'*/{POST_INDEX_UPDATE_MINUTES}'),
+    },
+    # refresh active users' entries before they go stale (see PREWARM_* in config)
+    'prewarm-recommendations': {
+        'task': 'tasks.prewarm_recommendations',
+        'schedule': crontab(minute=30),  # hourly, at :30
+    },
+    # publish time-decayed trending lists (cold start) to Redis
+    'publish-trending': {
+        'task': 'tasks.publish_trending',
+        'schedule': crontab(minute='*/15'),  # every 15 minutes
+    },
+}
@@ -1,18 +1,84 @@
+import json
 import logging
+import math
+import threading
+import time
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Any
-
-from config import TOP_K
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Tuple
+
+from config import (
+    TOP_K,
+    CACHE_EXPIRY_HOURS,
+    CACHE_WRITE_BATCH_SIZE,
+    NIGHTLY_USER_BATCH_SIZE,
+    NIGHTLY_CHECKPOINT_TTL_SECONDS,
+    HEURISTICS_REFRESH_INTERVAL_SECONDS,
+    HYBRID_CANDIDATES,
+    HYBRID_WEIGHT_SIMILARITY,
+    HYBRID_WEIGHT_COLLABORATIVE,
+    HYBRID_WEIGHT_COLD_START,
+)
 from model_loader import get_recommendation_model          # ✅ only PKL model from here
 from embedding_generator import get_embedding_generator    # ✅ SBERT embedder from here
 from faiss_indexer import get_faiss_indexer
+from user_embedding_store import get_user_embedding_store
+from collaborative_index import CollaborativeIndex
+from feature_tables import (
+    PostFeatureTable,
+    UserProfileTable,
+    POST_FEATURE_FIELDS,
+    USER_PROFILE_FIELDS,
+)
+from id_interner import IdInterner
+from trending import TrendingLists
 from database import get_mongo_connection
 from upstash_client import upstash_client  # your existing Upstash wrapper
 
 logger = logging.getLogger(__name__)
 
+# re-read a little before the last watermark to tolerate clock skew with Mongo;
+# patching is idempotent so the overlap is harmless
+REFRESH_WATERMARK_OVERLAP = timedelta(seconds=60)
+
+# user fields that make up the profile text
+PROFILE_TEXT_FIELDS = ["username", "bio", "interests"]
+# prefix of the nightly checkpoint keys; every caller gets its own (see nightly_checkpoint_key)
+NIGHTLY_CHECKPOINT_KEY = "nightly:checkpoint"
+
+
+def nightly_checkpoint_key(caller: str) -> str:
+    """Checkpoint key of one nightly caller, so separate jobs never resume from each other's cursor."""
+    return f"{NIGHTLY_CHECKPOINT_KEY}:{caller}"
+
+
+def profile_text(username, bio, interests) -> str:
+    """Text encoded by SBERT as the user's query: username + bio + interests."""
+    return " ".join("" if _is_missing(value) else str(value) for value in (username, bio, interests))
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def seen_posts(db_conn, user_ids) -> list:
+    """Post ids each user has voted on (one list per user, same order), excluded from their results."""
+    votes = db_conn.get_vote_arrays("post", {"user_id": {"$in": [ObjectId(u) for u in user_ids]}})
+    seen = [[] for _ in user_ids]
+    if not votes.n_votes:
+        return seen
+
+    row_of = {user_id: row for row, user_id in enumerate(user_ids)}
+    vote_rows = np.array([row_of.get(user_id, -1) for user_id in votes.user_ids])[votes.user_idx]
+    order = np.argsort(vote_rows, kind="stable")
+    targets = votes.target_ids[votes.target_idx[order]]
+    bounds = np.searchsorted(vote_rows[order], np.arange(len(user_ids) + 1))
+    for row in range(len(user_ids)):
+        seen[row] = targets[bounds[row]:bounds[row + 1]].tolist()
+    return seen
+
 
 class AdvancedTopKRecommender:
     def __init__(self, top_k: int = TOP_K):
@@ -41,192 +107,164 @@ class AdvancedTopKRecommender:
         self.db_conn = get_mongo_connection()  # has .db attribute
         self.db = self.db_conn.db
 
+        # ObjectId string <-> dense int32 index, shared by every structure below
+        self.user_interner = IdInterner()
+        self.post_interner = IdInterner()
+        self.community_interner = IdInterner()
+
         # heuristic / collaborative data
-        self.posts_df: pd.DataFrame = pd.DataFrame()
-        self.user_post_matrix: pd.DataFrame | None = None
-        self.user_similarity_df: pd.DataFrame | None = None
-        self.user_profiles: Dict[str, Dict[str, Any]] = {}
+        self.post_features = PostFeatureTable(self.post_interner, self.community_interner)
+        self.collab_index: CollaborativeIndex | None = None
+        self.user_profiles = UserProfileTable(self.user_interner, self.community_interner)
+        # time-decayed popularity + global/per-community trending lists (cold start)
+        self.trending: TrendingLists | None = None
+        self._heuristics_watermark: datetime | None = None
+        self._refresh_lock = threading.Lock()
+        # (cache key, mask) of the last allowed_post_mask
+        self._allowed_mask_cache: Tuple[tuple, np.ndarray] | None = None
 
         # initialize heuristic data at startup
         self._init_heuristics_data()
 
-    # ----------------- small helpers -----------------
-    def _safe_int(self, value, default: int = 0) -> int:
-        """
-        Safely convert value to int:
-        - Treats None/NaN as default
-        - Handles strings, floats, etc.
-        """
-        import math
-
-        if value is None:
-            return default
-        try:
-            if isinstance(value, float) and math.isnan(value):
-                return default
-            return int(value)
-        except Exception:
-            return default
-
     # ----------------- Initialization helpers -----------------
     def _init_heuristics_data(self):
         logger.info("[HEURISTICS] initializing data...")
         try:
-            # -------- posts --------
-            posts_df = self.db_conn.get_posts()
-            if posts_df is None or posts_df.empty:
-                logger.warning("[HEURISTICS] no posts found")
-                self.posts_df = pd.DataFrame()
-            else:
-                # rename _id -> post_id is already done in get_posts()
-                # ensure post_id is string
-                if "post_id" in posts_df.columns:
-                    posts_df["post_id"] = posts_df["post_id"].astype(str)
-
-                # ensure community_id is string if exists
-                if "community_id" in posts_df.columns:
-                    posts_df["community_id"] = posts_df["community_id"].astype(str)
+            self.refresh_heuristics_data()
+            logger.info("[HEURISTICS] init complete")
+        except Exception as e:
+            # the watermark is still unset, so the next refresh retries the full load
+            logger.exception(f"[HEURISTICS] init failed: {e}")
 
-                # ensure score column exists
-                if "score" not in posts_df.columns:
-                    posts_df["score"] = 0
+    # ----------------- Incremental refresh -----------------
+    def refresh_heuristics_data(self) -> Dict[str, int]:
+        """
+        Patch post_features, user_profiles and the collaborative index in place with
+        documents whose `updatedAt` is newer than the last load/refresh, instead
+        of rebuilding everything from a full Mongo scan. Until a load has
+        succeeded (no watermark yet) every document is read.
+
+        Hard-deleted documents are not seen (posts are soft-removed via status).
+        Returns counts of what was patched. If a Mongo read fails the error is
+        raised before the vote patch and the watermark move, so nothing is
+        dropped and the next refresh re-reads the same window. A failed full
+        vote read only leaves collab_index unset; it is retried next refresh.
+        """
+        with self._refresh_lock:
+            started_at = datetime.now(timezone.utc)
+            if self._heuristics_watermark is None:
+                changed_filter = {}
+            else:
+                changed_filter = {"updatedAt": {"$gt": self._heuristics_watermark - REFRESH_WATERMARK_OVERLAP}}
+            stats = {"posts": 0, "users": 0, "vote_users": 0, "neighbors_recomputed": 0}
 
-                self.posts_df = posts_df
-                logger.info(f"[HEURISTICS] loaded {len(self.posts_df)} posts")
+            # streamed straight from the cursors (get_posts / get_users would turn a failed read into "no changes")
+            # -------- posts --------
+            for chunk in self.db_conn.iter_posts(changed_filter, POST_FEATURE_FIELDS):
+                stats["posts"] += self.post_features.upsert(pd.DataFrame(chunk))
+            if stats["posts"]:
+                self._rebuild_trending()
 
             # -------- user profiles --------
-            users_df = self.db_conn.get_users()
-            if users_df is None or users_df.empty:
-                logger.warning("[HEURISTICS] no users found")
-                self.user_profiles = {}
-            else:
-                self.user_profiles = {}
-                for _, row in users_df.iterrows():
-                    uid = str(row.get("user_id") or row.get("_id"))
-                    if not uid:
-                        continue
-
-                    num_posts = self._safe_int(row.get("num_posts"), 0)
-                    num_comments = self._safe_int(row.get("num_comments"), 0)
-
-                    total_votes = num_posts + num_comments
-
-                    communities = row.get("communities_followed") or []
-                    top_communities = {}
-                    try:
-                        for c in communities:
-                            top_communities[str(c)] = 1
-                    except Exception:
-                        top_communities = {}
-
-                    self.user_profiles[uid] = {
-                        "total_votes": total_votes,
-                        "top_communities": top_communities,
-                        "num_posts": num_posts,
-                        "num_comments": num_comments,
-                    }
-
-                logger.info(f"[HEURISTICS] built user_profiles for {len(self.user_profiles)} users")
-
-            # -------- votes / collaborative matrix --------
-            votes_df = self._load_votes_df()
-            if votes_df is not None and not votes_df.empty:
-                try:
-                    upr = votes_df[votes_df["target_type"] == "post"]
-                    if upr.empty:
-                        logger.info("[HEURISTICS] no post votes in votes_df; collaborative disabled")
-                        self.user_post_matrix = None
-                        self.user_similarity_df = None
-                    else:
-                        matrix = upr.pivot_table(
-                            index="user_id",
-                            columns="target_id",
-                            values="value",
-                            fill_value=0,
-                        )
-                        self.user_post_matrix = matrix
-
-                        sim = cosine_similarity(matrix)
-                        self.user_similarity_df = pd.DataFrame(
-                            sim,
-                            index=matrix.index,
-                            columns=matrix.index,
-                        )
-                        logger.info(f"[HEURISTICS] built user-post matrix {matrix.shape}")
-                except Exception as e:
-                    logger.exception(f"[HEURISTICS] error building matrix/similarity: {e}")
-                    self.user_post_matrix = None
-                    self.user_similarity_df = None
+            for chunk in self.db_conn.iter_users(changed_filter, USER_PROFILE_FIELDS):
+                stats["users"] += self.user_profiles.upsert(pd.DataFrame(chunk))
+
+            # -------- votes --------
+            if self.collab_index is None:
+                # nothing to patch yet: build from the full collection
+                stats["neighbors_recomputed"] = self._build_collab_index()
             else:
-                logger.info("[HEURISTICS] no votes data found; collaborative disabled")
-                self.user_post_matrix = None
-                self.user_similarity_df = None
+                vote_users = self._load_vote_user_ids(changed_filter)
+                if vote_users:
+                    votes = self.db_conn.get_vote_arrays("post", changed_filter)
+                    stats["neighbors_recomputed"] = self.collab_index.update_users(vote_users, votes)
+                stats["vote_users"] = len(vote_users)
 
-            logger.info("[HEURISTICS] init complete")
-        except Exception as e:
-            logger.exception(f"[HEURISTICS] init failed: {e}")
-            # graceful fallback
-            self.posts_df = pd.DataFrame()
-            self.user_profiles = {}
-            self.user_post_matrix = None
-            self.user_similarity_df = None
-
-    def _load_votes_df(self) -> pd.DataFrame:
-        """
-        Read votes collection and flatten to rows:
-        Each votes document may look like your example:
-        {
-          _id: ...,
-          user_id: ...,
-          votes: {
-            post: { target_ids: [...], value: 1 },
-            comment: { ... }
-          }
-        }
-        We'll expand post votes into rows:
-        user_id, target_id, value, target_type='post'
+            self._heuristics_watermark = started_at
+            logger.info(f"[HEURISTICS] incremental refresh: {stats}")
+            return stats
+
+    def _build_collab_index(self) -> int:
+        """
+        Build collab_index from every post vote; returns the number of user rows.
+        Failures are logged and leave it unset (collaborative scoring disabled).
         """
         try:
-            rows = []
-            coll = self.db.get_collection("votes")
-            for doc in coll.find({}):
-                # user id stored as user_id (ObjectId or string)
-                uid = doc.get("user_id")
-                uid = str(uid) if uid is not None else str(doc.get("_id", ""))
-
-                votes = doc.get("votes", {}) or {}
-                post_votes = votes.get("post") or {}
-                if isinstance(post_votes, dict):
-                    target_ids = post_votes.get("target_ids", []) or []
-                    value = post_votes.get("value", 0) or 0
-                    value = self._safe_int(value, 0)
-
-                    for tid in target_ids:
-                        rows.append(
-                            {
-                                "user_id": uid,
-                                "target_id": str(tid),
-                                "value": value,
-                                "target_type": "post",
-                            }
-                        )
-
-                # You can also flatten comment votes here if you need them
-
-            if not rows:
-                return pd.DataFrame()
-            return pd.DataFrame(rows)
+            votes = self.db_conn.get_vote_arrays("post")
+            if not votes.n_votes:
+                logger.info("[HEURISTICS] no post votes found; collaborative disabled")
+                return 0
+            self.collab_index = CollaborativeIndex.from_vote_arrays(
+                votes, self.user_interner, self.post_interner
+            )
         except Exception as e:
-            logger.exception(f"[HEURISTICS] load_votes_df error: {e}")
-            return pd.DataFrame()
+            logger.exception(f"[HEURISTICS] error building matrix/neighbours: {e}")
+            self.collab_index = None
+            return 0
+        logger.info(
+            f"[HEURISTICS] built sparse user-post matrix {self.collab_index.shape} "
+            f"({self.collab_index.matrix.nnz} votes)"
+        )
+        return self.collab_index.shape[0]
+
+    @property
+    def heuristics_age_seconds(self) -> float:
+        """Seconds since the heuristics data was last loaded or refreshed (inf before the first load)."""
+        if self._heuristics_watermark is None:
+            return math.inf
+        return (datetime.now(timezone.utc) - self._heuristics_watermark).total_seconds()
+
+    def refresh_heuristics_if_stale(self, max_age_seconds: float = HEURISTICS_REFRESH_INTERVAL_SECONDS):
+        """
+        Patch the heuristics data when it is older than max_age_seconds (for processes
+        without the API's refresh loop). A failed refresh keeps the current data.
+        """
+        if self.heuristics_age_seconds > max_age_seconds:
+            try:
+                self.refresh_heuristics_data()
+            except Exception:
+                logger.exception("[HEURISTICS] refresh failed; keeping current data")
+
+    def _load_vote_user_ids(self, filter_query=None) -> List[str]:
+        """User ids of the votes documents matching filter_query (raises if Mongo fails)."""
+        coll = self.db.get_collection("votes")
+        user_ids = []
+        for doc in coll.find(filter_query or {}, {"user_id": 1}):
+            uid = doc.get("user_id")
+            user_ids.append(str(uid) if uid is not None else str(doc.get("_id", "")))
+        return user_ids
 
     # ----------------- Cold-start detection -----------------
     def is_cold_start_user(self, user_id: str) -> bool:
-        uid = str(user_id)
-        prof = self.user_profiles.get(uid)
-        if prof is None:
+        row = self.user_profiles.row(user_id)
+        if row < 0:
             return True
-        return prof.get("total_votes", 0) == 0
+        return bool(self.user_profiles.total_votes[row] == 0)
+
+    def _user_activity(self, row: int) -> float:
+        if row < 0:
+            return 0.0
+        return min(1.0, (int(self.user_profiles.num_posts[row]) + int(self.user_profiles.num_comments[row])) / 100.0)
+
+    def _rebuild_trending(self):
+        """Recompute the trending lists from the post feature table (keeps the old ones on failure)."""
+        try:
+            self.trending = TrendingLists(self.post_features)
+        except Exception as e:
+            logger.exception(f"[TRENDING] rebuild failed: {e}")
+
+    def _popularity(self, post_idx: np.ndarray) -> np.ndarray:
+        """
+        Time-decayed popularity of interned posts from the trending build; posts
+        it does not cover yet fall back to the undecayed PostFeatureTable.popularity.
+        """
+        post_idx = np.asarray(post_idx, dtype=np.int64)
+        popularity = self.post_features.popularity(post_idx)
+        if self.trending is not None:
+            decayed = self.trending.scores_of(post_idx)
+            has_decay = ~np.isnan(decayed)
+            popularity[has_decay] = decayed[has_decay]
+        return popularity
 
     # ----------------- Scoring functions -----------------
     def _get_cold_start_score(self, user_id: str, post_id: str) -> float:
@@ -234,98 +272,335 @@ class AdvancedTopKRecommender:
         Heuristic: community match (50%), popularity (30%), user activity (20%)
         Returns value between 0 and 1
         """
-        uid = str(user_id)
-        pid = str(post_id)
-        user_prof = self.user_profiles.get(
-            uid,
-            {
-                "total_votes": 0,
-                "top_communities": {},
-                "num_posts": 0,
-                "num_comments": 0,
-            },
-        )
-
-        if self.posts_df is None or self.posts_df.empty:
-            return 0.5
+        row = self.user_profiles.row(user_id)
 
-        post = self.posts_df[self.posts_df["post_id"] == pid]
-        if post.shape[0] == 0:
+        post_row = self.post_features.row(post_id)
+        if post_row < 0:
             return 0.5
 
-        post_community = str(post["community_id"].values[0]) if "community_id" in post.columns else ""
-        post_score = float(post["score"].values[0]) if "score" in post.columns else 0.0
+        post_community = int(self.post_features.community_idx[post_row])
 
-        community_match = 1.0 if post_community and post_community in user_prof.get("top_communities", {}) else 0.5
-        popularity_score = min(1.0, post_score / 100.0)
-        user_activity = min(
-            1.0,
-            (user_prof.get("num_posts", 0) + user_prof.get("num_comments", 0)) / 100.0,
-        )
+        followed = self.user_profiles.followed_communities(row)
+        community_match = 1.0 if post_community >= 0 and post_community in followed else 0.5
+        popularity_score = float(self._popularity(np.array([post_row]))[0])
+        user_activity = self._user_activity(row)
 
         cold_score = (community_match * 0.5) + (popularity_score * 0.3) + (user_activity * 0.2)
         return float(np.clip(cold_score, 0.0, 1.0))
 
     def _get_collaborative_score(self, user_id: str, post_id: str) -> float:
         """
-        Look at top-K similar users and average their votes on post_id.
+        Look at the user's precomputed top-K similar users and average their votes on post_id.
         Returns 0.5 (neutral) if no evidence.
         """
         try:
-            if self.user_similarity_df is None or self.user_post_matrix is None:
+            if self.collab_index is None:
                 return 0.5
+            return self.collab_index.score(user_id, post_id)
+        except Exception as e:
+            logger.exception(f"[HEURISTICS] collaborative score error: {e}")
+            return 0.5
 
-            uid = str(user_id)
-            pid = str(post_id)
+    def score_collaborative_batch(self, user_id: str, post_ids) -> np.ndarray:
+        """
+        Collaborative scores for all candidate posts of one user in a single pass:
+        neighbours are looked up once instead of once per post.
+        post_ids may be id strings or an int array of interned post indices.
+        Returns 0.5 (neutral) for posts with no evidence.
+        """
+        try:
+            if self.collab_index is None:
+                return np.full(len(post_ids), 0.5)
+            if isinstance(post_ids, np.ndarray) and np.issubdtype(post_ids.dtype, np.integer):
+                return self.collab_index.score_batch_idx(user_id, post_ids)
+            return self.collab_index.score_batch(user_id, post_ids)
+        except Exception as e:
+            logger.exception(f"[HEURISTICS] batch collaborative score error: {e}")
+            return np.full(len(post_ids), 0.5)
 
-            if uid not in self.user_similarity_df.index:
-                return 0.5
+    # ----------------- Vectorized cold-start ranking -----------------
+    def _cold_start_candidates(self, user_id: str) -> np.ndarray:
+        """
+        Interned indices of the active posts worth scoring for a cold-start user:
+        the global trending list merged with the lists of the communities they
+        follow. Falls back to every active post if the lists are not built.
+        """
+        if self.trending is None:
+            return self.post_features.active_rows()
+        row = self.user_profiles.row(user_id)
+        post_idx = self.trending.candidates(self.user_profiles.followed_communities(row))
+        # drop posts deactivated since the lists were built
+        post_idx = post_idx[post_idx < self.post_features.known.size]
+        return post_idx[self.post_features.known[post_idx] & self.post_features.active[post_idx]]
+
+    def _cold_start_scores(self, user_id: str, community_idx: np.ndarray, popularity: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `_get_cold_start_score` over many posts at once.
+        Same weights: community match (50%), popularity (30%), user activity (20%)
+        """
+        row = self.user_profiles.row(user_id)
+        followed = np.isin(community_idx, self.user_profiles.followed_communities(row))
+
+        community_match = np.where(followed, 1.0, 0.5)
+        popularity_score = popularity
+        user_activity = self._user_activity(row)
+
+        cold_scores = (community_match * 0.5) + (popularity_score * 0.3) + (user_activity * 0.2)
+        return np.clip(cold_scores, 0.0, 1.0)
+
+    @staticmethod
+    def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Indices of the k highest scores, best first. Uses argpartition to avoid a
+        full sort; ties keep their original order (same as a stable sort).
+        """
+        n = scores.shape[0]
+        if k <= 0 or n == 0:
+            return np.empty(0, dtype=np.int64)
+        if k < n:
+            kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+            candidates = np.flatnonzero(scores >= kth)
+        else:
+            candidates = np.arange(n)
+        order = np.lexsort((candidates, -scores[candidates]))
+        return candidates[order[:k]]
+
+    # ----------------- Candidate re-ranking -----------------
+    def _cold_start_score_matrix(self, user_ids, post_idx: np.ndarray) -> np.ndarray:
+        """
+        `_cold_start_scores` for a (users x candidates) matrix of interned post
+        indices; unknown posts (-1) get 0.5 like `_get_cold_start_score`.
+        """
+        rows = np.array([self.user_profiles.row(str(u)) for u in user_ids], dtype=np.int64)
+        known = (post_idx >= 0) & (post_idx < self.post_features.known.size)
+        known[known] = self.post_features.known[post_idx[known]]
+
+        community_idx = np.full(post_idx.shape, -1, dtype=np.int64)
+        popularity_score = np.zeros(post_idx.shape)
+        community_idx[known] = self.post_features.community_idx[post_idx[known]]
+        popularity_score[known] = self._popularity(post_idx[known])
+
+        # followed[user row, post community] for every pair, in one sparse gather
+        followed = self.user_profiles.followed
+        user_rows = np.broadcast_to(rows[:, None], post_idx.shape)
+        lookup = (user_rows >= 0) & (user_rows < followed.shape[0]) & (community_idx >= 0) \
+            & (community_idx < followed.shape[1])
+        match = np.zeros(post_idx.shape, dtype=bool)
+        if lookup.any():
+            match[lookup] = np.asarray(followed[user_rows[lookup], community_idx[lookup]]).ravel() > 0
+
+        community_match = np.where(match, 1.0, 0.5)
+        user_activity = np.array([self._user_activity(row) for row in rows])[:, None]
+
+        cold_scores = (community_match * 0.5) + (popularity_score * 0.3) + (user_activity * 0.2)
+        return np.where(known, np.clip(cold_scores, 0.0, 1.0), 0.5)
+
+    def rerank_candidates(self, user_ids, similarities: np.ndarray, candidate_ids: np.ndarray,
+                          top_k: int = None, weights: Tuple[float, float, float] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Second stage of hybrid ranking. Takes FAISS candidates for a batch of
+        users (FAISSIndexer.search_batch output: cosine similarities and post
+        ids, None for unfilled slots), scores every candidate with the
+        collaborative and cold-start features, and blends them with profile
+        similarity using `weights` (similarity, collaborative, cold-start;
+        default the HYBRID_WEIGHT_* settings). All scoring is done on
+        (users x candidates) arrays. Returns one top_k list per user.
+        """
+        if top_k is None:
+            top_k = self.top_k
+        candidate_ids = np.asarray(candidate_ids, dtype=object)
+        filled = np.not_equal(candidate_ids, None)
+        post_idx = self.post_interner.lookup_many(candidate_ids.ravel()).reshape(candidate_ids.shape)
+        post_idx = post_idx.astype(np.int64)
+
+        similarity = np.clip((1.0 + np.asarray(similarities, dtype=np.float64)) / 2.0, 0.0, 1.0)
+        if self.collab_index is not None:
+            collab_scores = self.collab_index.score_pairs(user_ids, post_idx)
+        else:
+            collab_scores = np.full(post_idx.shape, 0.5)
+        cold_scores = self._cold_start_score_matrix(user_ids, post_idx)
+
+        if weights is None:
+            weights = (HYBRID_WEIGHT_SIMILARITY, HYBRID_WEIGHT_COLLABORATIVE, HYBRID_WEIGHT_COLD_START)
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = weights / weights.sum()
+        final_scores = weights[0] * similarity + weights[1] * collab_scores + weights[2] * cold_scores
+        final_scores[~filled] = -np.inf
+
+        # stable, so equal blends keep FAISS order
+        order = np.argsort(-final_scores, axis=1, kind="stable")[:, :top_k]
+        top_scores = np.take_along_axis(final_scores, order, axis=1)
+        top_ids = np.take_along_axis(candidate_ids, order, axis=1)
+
+        results = []
+        for ids, scores in zip(top_ids, top_scores):
+            n = int(np.isfinite(scores).sum())
+            results.append([
+                {"item_id": str(pid), "score": float(score), "rank": rank}
+                for rank, (pid, score) in enumerate(zip(ids[:n], scores[:n].tolist()), 1)
+            ])
+        return results
+
+    def allowed_post_mask(self, indexer) -> np.ndarray:
+        """
+        FAISS id mask of the known, active posts (None = no filter if no posts are loaded).
+        Cached until the post features or the index's ids change. Treat it as read-only.
+        """
+        if not len(self.post_features):
+            return None
+        key = (id(indexer), indexer.ids_version, self.post_features.generation)
+        cached = self._allowed_mask_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        mask = indexer.id_mask(self.post_interner.ids_of(self.post_features.active_rows()))
+        self._allowed_mask_cache = (key, mask)
+        return mask
+
+    # ----------------- Batch generation (nightly / pre-warm) -----------------
+    def generate_all_users_hybrid(self, strategy: str = "weighted", pkl_weight: float = 0.6,
+                                  sbert_weight: float = 0.4) -> Dict[str, Any]:
+        """
+        Nightly job: generate and cache hybrid recommendations for every user.
 
-            sims = self.user_similarity_df[uid].nlargest(6)
-            # skip self
-            sims = sims.iloc[1:6] if len(sims) > 1 else sims.iloc[0:0]
+        sbert_weight weights profile similarity; pkl_weight weights the
+        heuristic model (collaborative + cold-start features, split in the
+        HYBRID_WEIGHT_* proportion). Only the 'weighted' strategy exists.
+        Progress is checkpointed, so a crashed or timed-out run picks up where
+        it stopped when called again. Returns successful / failed counts.
+        """
+        if strategy != "weighted":
+            raise ValueError(f"Unknown strategy: {strategy}")
+        heuristic_total = HYBRID_WEIGHT_COLLABORATIVE + HYBRID_WEIGHT_COLD_START
+        weights = (
+            sbert_weight,
+            pkl_weight * HYBRID_WEIGHT_COLLABORATIVE / heuristic_total,
+            pkl_weight * HYBRID_WEIGHT_COLD_START / heuristic_total,
+        )
+        checkpoint_key = nightly_checkpoint_key(f"hybrid:{strategy}:{pkl_weight:g}:{sbert_weight:g}")
+        return self.generate_for_users(checkpoint_key=checkpoint_key, weights=weights)
 
-            votes = []
-            for sim_uid in sims.index:
-                if pid in self.user_post_matrix.columns and sim_uid in self.user_post_matrix.index:
-                    vote = self.user_post_matrix.at[sim_uid, pid]
-                    if vote != 0:
-                        votes.append(vote)
+    def generate_for_users(self, filter_query=None, batch_size: int = NIGHTLY_USER_BATCH_SIZE,
+                           pause_seconds: float = 0.0, checkpoint_key: Optional[str] = None,
+                           weights: Tuple[float, float, float] = None) -> Dict[str, Any]:
+        """
+        Generate and cache recommendations for the users matching filter_query.
+
+        Users are streamed from Mongo in _id order, batch_size at a time; each
+        batch is encoded in one SBERT call (reusing stored embeddings), searched
+        as one FAISS query matrix for HYBRID_CANDIDATES candidates per user,
+        re-ranked with rerank_candidates and written with pipelined Upstash
+        requests, sleeping pause_seconds between batches.
+
+        With checkpoint_key, the last user id written and the running totals
+        are saved to Redis after every batch; a later call with the same key
+        resumes after that user (within NIGHTLY_CHECKPOINT_TTL_SECONDS). The
+        checkpoint is deleted once the run completes.
+        Returns successful / failed counts (including resumed progress).
+        """
+        if self.indexer is None or self.embedder is None:
+            raise RuntimeError("FAISS index or SBERT model unavailable")
+        self.indexer.reload_if_changed()
+        self.refresh_heuristics_if_stale()
+        embedding_store = get_user_embedding_store()
+
+        checkpoint = self._load_checkpoint(checkpoint_key)
+        stats = {"successful": checkpoint.get("successful", 0), "failed": checkpoint.get("failed", 0)}
+        if checkpoint.get("last_user_id"):
+            logger.info(f"[BATCH] resuming after user {checkpoint['last_user_id']} ({stats})")
+            resume = {"_id": {"$gt": ObjectId(checkpoint["last_user_id"])}}
+            filter_query = {"$and": [filter_query, resume]} if filter_query else resume
+
+        # only known, active posts may be recommended
+        allowed = self.allowed_post_mask(self.indexer)
+
+        batches = self.db_conn.iter_users(filter_query, projection=PROFILE_TEXT_FIELDS,
+                                          batch_size=batch_size, sort=[("_id", 1)])
+        for batch_no, batch in enumerate(batches):
+            if batch_no and pause_seconds > 0:
+                time.sleep(pause_seconds)
+            user_ids = [str(user_id) for user_id in batch["user_id"]]
+            profile_texts = [
+                profile_text(username, bio, interests)
+                for username, bio, interests in zip(batch["username"], batch["bio"], batch["interests"])
+            ]
+
+            # only users whose profile text changed since the last run go through SBERT
+            embeddings = embedding_store.encode(user_ids, profile_texts, self.embedder.model)
+            embedding_store.flush()
+
+            similarities, candidate_ids = self.indexer.search_batch(
+                embeddings, k=HYBRID_CANDIDATES, exclude=seen_posts(self.db_conn, user_ids), allowed=allowed
+            )
+            ranked = self.rerank_candidates(user_ids, similarities, candidate_ids, weights=weights)
+
+            stored = self._store_in_chunks(dict(zip(user_ids, ranked)))
+            stats["successful"] += stored
+            stats["failed"] += len(user_ids) - stored
+            self._save_checkpoint(checkpoint_key, user_ids[-1], stats)
+            logger.info(f"[BATCH] done for {stats['successful'] + stats['failed']} users ({stats['failed']} failed)")
+
+        self._clear_checkpoint(checkpoint_key)
+        return stats
+
+    def _store_in_chunks(self, user_recommendations: Dict[str, list]) -> int:
+        """Write recommendations through Upstash pipelines of CACHE_WRITE_BATCH_SIZE users. Returns #stored."""
+        user_ids = list(user_recommendations)
+        stored = 0
+        for start in range(0, len(user_ids), CACHE_WRITE_BATCH_SIZE):
+            chunk = {uid: user_recommendations[uid] for uid in user_ids[start:start + CACHE_WRITE_BATCH_SIZE]}
+            results = self.cache.store_batch_recommendations(chunk, expiry_hours=CACHE_EXPIRY_HOURS)
+            stored += sum(1 for ok in results.values() if ok)
+        return stored
+
+    def _load_checkpoint(self, key: Optional[str]) -> Dict[str, Any]:
+        if key is None:
+            return {}
+        try:
+            value = self.cache.sync_redis.get(key)
+            return json.loads(value) if value else {}
+        except Exception:
+            logger.exception(f"[BATCH] could not read checkpoint {key}; starting from the beginning")
+            return {}
 
-            if votes:
-                score = float(np.clip(np.mean(votes), 0.0, 1.0))
-                return score
+    def _save_checkpoint(self, key: Optional[str], last_user_id: str, stats: Dict[str, Any]):
+        if key is None:
+            return
+        try:
+            value = json.dumps({"last_user_id": last_user_id, **stats})
+            self.cache.sync_redis.set(key, value, ex=NIGHTLY_CHECKPOINT_TTL_SECONDS)
+        except Exception:
+            logger.exception(f"[BATCH] could not write checkpoint {key}")
 
-            return 0.5
-        except Exception as e:
-            logger.exception(f"[HEURISTICS] collaborative score error: {e}")
-            return 0.5
+    def _clear_checkpoint(self, key: Optional[str]):
+        if key is None:
+            return
+        try:
+            self.cache.sync_redis.delete(key)
+        except Exception:
+            logger.exception(f"[BATCH] could not clear checkpoint {key}")
 
     # ----------------- Cold-start recommendation generator -----------------
     def get_cold_start_recommendations(self, user_id: str, top_k: int = None) -> List[Dict[str, Any]]:
         if top_k is None:
             top_k = self.top_k
-        if self.posts_df is None or self.posts_df.empty:
+        post_idx = self._cold_start_candidates(user_id)
+        if post_idx.size == 0:
             return []
 
-        candidates: List[Dict[str, Any]] = []
-        for _, row in self.posts_df.iterrows():
-            pid = str(row["post_id"])
-
-            # only rank active posts if status exists
-            if "status" in row and row["status"] != "active":
-                continue
-
-            cold_score = self._get_cold_start_score(user_id, pid)
-            collab_score = self._get_collaborative_score(user_id, pid)
-            final_score = 0.6 * cold_score + 0.4 * collab_score
+        cold_scores = self._cold_start_scores(
+            user_id, self.post_features.community_idx[post_idx], self._popularity(post_idx)
+        )
 
-            candidates.append({"item_id": pid, "score": float(final_score)})
+        collab_scores = self.score_collaborative_batch(user_id, post_idx)
+        final_scores = 0.6 * cold_scores + 0.4 * collab_scores
 
-        candidates.sort(key=lambda x: x["score"], reverse=True)
-        top = candidates[:top_k]
-        for i, item in enumerate(top, 1):
-            item["rank"] = i
+        top_idx = self._top_k_indices(final_scores, top_k)
+        top = [
+            {"item_id": pid, "score": float(score), "rank": rank}
+            for rank, (pid, score) in enumerate(
+                zip(self.post_interner.ids_of(post_idx[top_idx]), final_scores[top_idx]), 1
+            )
+        ]
 
         # cache into upstash for quicker subsequent hits
         try:
@@ -336,28 +611,15 @@ class AdvancedTopKRecommender:
         return top
 
     # ----------------- Public entry for API -----------------
-    def get_hybrid_recommendations(self, user_id: str) -> Dict[str, Any]:
+    def get_uncached_recommendations(self, user_id: str) -> Dict[str, Any]:
         """
-        Called by FastAPI:
-        - If cache hit -> return cached
-        - If cold-start user -> compute and return cold_start recs (and cache them)
-        - Otherwise -> return {'recommendations': None, 'source':'on_demand'} so caller may enqueue Celery
+        Called by FastAPI after a cache miss (the endpoint does the stale-aware
+        cache check): cold-start ranking, or {'recommendations': None} when
+        Celery should take over. CPU-bound, so the async API runs it in a
+        worker thread.
         """
         uid = str(user_id)
 
-        # cache check (Upstash)
-        try:
-            cached = self.cache.get_user_recommendations(uid)
-            if cached:
-                return {
-                    "user_id": uid,
-                    "recommendations": cached,
-                    "source": "cache",
-                    "strategy": "cache",
-                }
-        except Exception:
-            logger.exception("Cache read failed")
-
         # cold start?
         if self.is_cold_start_user(uid):
             logger.info(f"[HYBRID] Cold-start user detected: {uid}")
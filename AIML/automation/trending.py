@@ -0,0 +1,136 @@
+# trending.py
+
+import json
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+from config import (
+    TRENDING_HALF_LIFE_DAYS,
+    TRENDING_GLOBAL_SIZE,
+    TRENDING_COMMUNITY_SIZE,
+    TRENDING_REDIS_TTL_SECONDS,
+    CACHE_WRITE_BATCH_SIZE,
+)
+from feature_tables import PostFeatureTable
+
+logger = logging.getLogger(__name__)
+
+TRENDING_GLOBAL_KEY = "trending:global"
+TRENDING_COMMUNITY_KEY = "trending:community:{}"
+
+
+def temporal_weights(created_at: np.ndarray, half_life_days: float = TRENDING_HALF_LIFE_DAYS,
+                     ref_time: float = None) -> np.ndarray:
+    """
+    Exponential recency weight per post: exp(-days_old / half_life_days)
+    clipped to [0.1, 1], where days_old is whole days before ref_time (default:
+    the newest post). Posts without a creation time get 0.5.
+    """
+    weights = np.full(created_at.shape, 0.5)
+    known = ~np.isnan(created_at)
+    if known.any():
+        if ref_time is None:
+            ref_time = float(created_at[known].max())
+        days_old = np.floor((ref_time - created_at[known]) / 86400.0)
+        weights[known] = np.clip(np.exp(-days_old / half_life_days), 0.1, 1.0)
+    return weights
+
+
+class TrendingLists:
+    """
+    Time-decayed popularity of every post (PostFeatureTable.popularity x
+    temporal weight) plus the top active posts by it: one global list and one list per
+    community, best first, stored CSR-style (community_indptr into
+    community_posts). Built from a PostFeatureTable in one vectorised pass.
+    """
+
+    def __init__(self, post_features: PostFeatureTable, global_size: int = TRENDING_GLOBAL_SIZE,
+                 community_size: int = TRENDING_COMMUNITY_SIZE,
+                 half_life_days: float = TRENDING_HALF_LIFE_DAYS):
+        self.posts = post_features.posts
+        self.communities = post_features.communities
+
+        created_at = post_features.created_at
+        known_time = created_at[~np.isnan(created_at)]
+        self.ref_time = float(known_time.max()) if known_time.size else None
+        self.post_scores = (
+            post_features.popularity()
+            * temporal_weights(created_at, half_life_days, self.ref_time)
+        )
+
+        active = post_features.active_rows().astype(np.int64)
+        scores = self.post_scores[active]
+
+        # global: stable, so ties keep index order
+        self.global_posts = active[np.argsort(-scores, kind="stable")[:global_size]]
+
+        # per community: sort by (community, -score, index), keep the first community_size of each
+        community_idx = post_features.community_idx[active].astype(np.int64)
+        has_community = community_idx >= 0
+        active, scores, community_idx = active[has_community], scores[has_community], community_idx[has_community]
+        order = np.lexsort((active, -scores, community_idx))
+        active, community_idx = active[order], community_idx[order]
+
+        n_communities = len(self.communities)
+        starts = np.searchsorted(community_idx, np.arange(n_communities))
+        rank = np.arange(community_idx.size) - starts[community_idx]
+        keep = rank < community_size
+        self.community_posts = active[keep]
+        self.community_indptr = np.zeros(n_communities + 1, dtype=np.int64)
+        np.cumsum(np.bincount(community_idx[keep], minlength=n_communities), out=self.community_indptr[1:])
+
+        logger.info(
+            f"[TRENDING] built global list ({self.global_posts.size}) and "
+            f"{int((np.diff(self.community_indptr) > 0).sum())} community lists"
+        )
+
+    def scores_of(self, post_idx: np.ndarray) -> np.ndarray:
+        """Decayed popularity for interned post indices; NaN for posts newer than this build."""
+        post_idx = np.asarray(post_idx, dtype=np.int64)
+        out = np.full(post_idx.shape, np.nan)
+        inside = (post_idx >= 0) & (post_idx < self.post_scores.size)
+        out[inside] = self.post_scores[post_idx[inside]]
+        return out
+
+    def community_list(self, community: int) -> np.ndarray:
+        """Trending post indices of one interned community, best first."""
+        if community < 0 or community + 1 >= self.community_indptr.size:
+            return np.empty(0, dtype=np.int64)
+        return self.community_posts[self.community_indptr[community]:self.community_indptr[community + 1]]
+
+    def candidates(self, communities) -> np.ndarray:
+        """Global list merged with the lists of the given interned communities (unique post indices)."""
+        lists = [self.global_posts] + [self.community_list(int(c)) for c in communities]
+        return np.unique(np.concatenate(lists))
+
+    # -------- Redis --------
+
+    def _payload(self, post_idx: np.ndarray) -> str:
+        return json.dumps({
+            "post_ids": self.posts.ids_of(post_idx).tolist(),
+            "scores": np.round(self.post_scores[post_idx], 6).tolist(),
+            "ref_time": (
+                datetime.fromtimestamp(self.ref_time, tz=timezone.utc).isoformat()
+                if self.ref_time is not None else None
+            ),
+        })
+
+    def publish(self, redis_client, ttl_seconds: int = TRENDING_REDIS_TTL_SECONDS) -> int:
+        """Write the global and per-community lists to Redis through pipelines. Returns #keys written."""
+        entries = [(TRENDING_GLOBAL_KEY, self.global_posts)]
+        for community in np.flatnonzero(np.diff(self.community_indptr) > 0):
+            entries.append((
+                TRENDING_COMMUNITY_KEY.format(self.communities.id_of(int(community))),
+                self.community_list(int(community)),
+            ))
+
+        for start in range(0, len(entries), CACHE_WRITE_BATCH_SIZE):
+            pipeline = redis_client.pipeline()
+            for key, post_idx in entries[start:start + CACHE_WRITE_BATCH_SIZE]:
+                pipeline.setex(key, ttl_seconds, self._payload(post_idx))
+            pipeline.exec()
+
+        logger.info(f"[TRENDING] published {len(entries)} lists to Redis")
+        return len(entries)
@@ -1,10 +1,18 @@
+import base64
 import json
 import logging
+import struct
+import time
+import uuid
+import zlib
 from typing import Any, List, Dict, Optional
+import numpy as np
 from upstash_redis import Redis
 from upstash_redis.asyncio import Redis as AsyncRedis
 import os
 from dotenv import load_dotenv  
+from config import CACHE_VALUE_FORMAT, CACHE_TTL_JITTER, CACHE_EXPIRY_HOURS, CACHE_STALE_HOURS
+from local_cache import LocalCache
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +20,106 @@ logger = logging.getLogger(__name__)
 # Load .env as soon as this module is imported
 load_dotenv()  
 
+# Packed value, schema v1: "rb1:" + base64 of
+#   uint32 timestamp, uint16 count | count x 12-byte ObjectId | count x float16 score
+# Ranks are implicit (list order). Values starting with "{" are the original JSON.
+PACKED_PREFIX = "rb1:"
+_PACKED_HEADER = struct.Struct("<IH")
+
+# compare-and-delete, so a lock is only released by the holder of its token
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def _pack_recommendations(recommendations: List[Dict[str, Any]], timestamp: int) -> Optional[str]:
+    """Packed v1 value, or None if the list does not fit the schema (JSON is used instead)."""
+    if len(recommendations) > 0xFFFF:
+        return None
+    try:
+        ids = bytes.fromhex("".join(str(r["item_id"]) for r in recommendations))
+        scores = np.array([r["score"] for r in recommendations], dtype="<f2")
+    except (KeyError, TypeError, ValueError):
+        return None
+    if len(ids) != 12 * len(recommendations) or not np.isfinite(scores).all():
+        return None
+    if any(r.get("rank") != i for i, r in enumerate(recommendations, 1)):
+        return None
+    payload = _PACKED_HEADER.pack(timestamp, len(recommendations)) + ids + scores.tobytes()
+    return PACKED_PREFIX + base64.b64encode(payload).decode("ascii")
+
+
+def encode_recommendations(
+    user_id: str, recommendations: List[Dict[str, Any]], timestamp: int = None, fmt: str = CACHE_VALUE_FORMAT
+) -> str:
+    """Serialize a user's cache entry in `fmt` ("json" or "packed")"""
+    timestamp = int(time.time()) if timestamp is None else int(timestamp)
+    if fmt == "packed":
+        value = _pack_recommendations(recommendations, timestamp)
+        if value is not None:
+            return value
+    return json.dumps({
+        "user_id": user_id,
+        "recommendations": recommendations,
+        "timestamp": timestamp
+    })
+
+
+def _jitter_factor(user_id: str, timestamp: int) -> float:
+    """
+    Factor in [1 - CACHE_TTL_JITTER, 1 + CACHE_TTL_JITTER] for one written entry, derived from
+    (user_id, timestamp) so every reader and the writer agree on it without storing it
+    """
+    unit = zlib.crc32(f"{user_id}:{int(timestamp)}".encode()) / 0xFFFFFFFF
+    return 1 + CACHE_TTL_JITTER * (2 * unit - 1)
+
+
+def stale_at(user_id: str, timestamp: int, expiry_hours: float = CACHE_EXPIRY_HOURS) -> float:
+    """
+    Soft deadline (epoch seconds) of an entry written at `timestamp`: the jittered fresh
+    period, so a batch of writes does not go stale (and trigger refreshes) at once
+    """
+    return timestamp + expiry_hours * 3600 * _jitter_factor(user_id, timestamp)
+
+
+def is_stale(user_id: str, entry: Dict[str, Any]) -> bool:
+    """Cached entry past its soft deadline"""
+    return time.time() > stale_at(user_id, entry.get("timestamp", 0))
+
+
+def _hard_ttl(user_id: str, timestamp: int, expiry_hours: float) -> int:
+    """Redis TTL in seconds: up to the entry's soft deadline, plus CACHE_STALE_HOURS of serve-stale grace"""
+    return max(1, int(stale_at(user_id, timestamp, expiry_hours) - timestamp + CACHE_STALE_HOURS * 3600))
+
+
+def _decoded_size(recommendations: List[Dict[str, Any]]) -> int:
+    """Rough in-memory bytes of a decoded list (dict + id str + float + int per entry), for the L1 cap"""
+    return 64 + 360 * len(recommendations)
+
+
+def decode_recommendations(value) -> Dict[str, Any]:
+    """Cache entry ({"recommendations", "timestamp"}) from either a packed or a JSON value"""
+    if isinstance(value, bytes):
+        value = value.decode("ascii")
+    if not value.startswith(PACKED_PREFIX):
+        return json.loads(value)
+
+    payload = base64.b64decode(value[len(PACKED_PREFIX):])
+    timestamp, count = _PACKED_HEADER.unpack_from(payload)
+    offset = _PACKED_HEADER.size
+    ids_hex = payload[offset:offset + 12 * count].hex()
+    scores = np.frombuffer(payload, dtype="<f2", count=count, offset=offset + 12 * count)
+    return {
+        "recommendations": [
+            {"item_id": ids_hex[24 * i:24 * (i + 1)], "score": score, "rank": i + 1}
+            for i, score in enumerate(scores.astype(np.float64).tolist())
+        ],
+        "timestamp": timestamp,
+    }
+
 
 
 class UpstashClient:
@@ -26,6 +134,9 @@ class UpstashClient:
             url=os.getenv("UPSTASH_REDIS_REST_URL"),
             token=os.getenv("UPSTASH_REDIS_REST_TOKEN")
         )
+        # L1 in front of Upstash for hot users. Writes below only invalidate this
+        # process's copy; other processes see them after L1_CACHE_TTL_SECONDS
+        self.local_cache = LocalCache()
 
     def store_user_recommendations(
         self, 
@@ -39,7 +150,7 @@ class UpstashClient:
         Args:
             user_id: Unique user identifier
             recommendations: List of recommendation dicts with item_id and score
-            expiry_hours: TTL in hours (default: 24)
+            expiry_hours: Hours the list is fresh (default: 24); the key lives CACHE_STALE_HOURS longer
         
         Returns:
             True if successful, False otherwise
@@ -47,16 +158,13 @@ class UpstashClient:
         try:
             key = f"recommendations:{user_id}"
             
-            # Serialize recommendations to JSON
-            value = json.dumps({
-                "user_id": user_id,
-                "recommendations": recommendations,
-                "timestamp": int(__import__('time').time())
-            })
+            # Serialize recommendations (JSON or packed, per CACHE_VALUE_FORMAT)
+            timestamp = int(time.time())
+            value = encode_recommendations(user_id, recommendations, timestamp)
             
             # Store with expiration
-            expiry_seconds = expiry_hours * 3600
-            self.sync_redis.setex(key, expiry_seconds, value)
+            self.sync_redis.setex(key, _hard_ttl(user_id, timestamp, expiry_hours), value)
+            self.local_cache.invalidate(key)
             
             logger.info(f"✓ Stored {len(recommendations)} recommendations for user {user_id}")
             return True
@@ -65,24 +173,49 @@ class UpstashClient:
             logger.error(f"✗ Error storing recommendations for {user_id}: {str(e)}")
             return False
 
-    def get_user_recommendations(self, user_id: str) -> Optional[List[Dict[str, Any]]]:
+    def _local_entry(self, user_id: str, key: str) -> Optional[Dict[str, Any]]:
         """
-        Retrieve cached recommendations for a user (< 0.1s response)
-        
+        L1 entry while it is still fresh. Stale entries never come from L1: once a
+        refresh lands (and its lock is released) readers must see it in Upstash
+        rather than a stale local copy that would queue another refresh.
+        """
+        entry = self.local_cache.get(key)
+        if entry is None:
+            return None
+        if is_stale(user_id, entry):
+            self.local_cache.invalidate(key)
+            return None
+        logger.debug(f"✓ L1 cache hit for user {user_id}")
+        return entry
+
+    def _cache_locally(self, user_id: str, key: str, entry: Dict[str, Any]):
+        """Keep a decoded entry in L1, unless it is already stale (see _local_entry)"""
+        if not is_stale(user_id, entry):
+            self.local_cache.set(key, entry, _decoded_size(entry["recommendations"]))
+
+    def get_user_entry(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cached entry for a user: {"recommendations": [...], "timestamp": written_at}
+
         Args:
             user_id: Unique user identifier
-        
+
         Returns:
-            List of recommendations or None if not cached
+            Entry dict or None if not cached
         """
         try:
             key = f"recommendations:{user_id}"
+            entry = self._local_entry(user_id, key)
+            if entry is not None:
+                return entry
+
             value = self.sync_redis.get(key)
             
             if value:
-                data = json.loads(value)
+                entry = decode_recommendations(value)
+                self._cache_locally(user_id, key, entry)
                 logger.info(f"✓ Cache hit for user {user_id}")
-                return data["recommendations"]
+                return entry
             
             logger.info(f"✗ Cache miss for user {user_id}")
             return None
@@ -91,6 +224,42 @@ class UpstashClient:
             logger.error(f"✗ Error retrieving recommendations for {user_id}: {str(e)}")
             return None
 
+    async def aget_user_entry(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Async version of get_user_entry, for use on the API event loop"""
+        try:
+            key = f"recommendations:{user_id}"
+            entry = self._local_entry(user_id, key)
+            if entry is not None:
+                return entry
+
+            value = await self.async_redis.get(key)
+
+            if value:
+                entry = decode_recommendations(value)
+                self._cache_locally(user_id, key, entry)
+                logger.info(f"✓ Cache hit for user {user_id}")
+                return entry
+
+            logger.info(f"✗ Cache miss for user {user_id}")
+            return None
+
+        except Exception as e:
+            logger.error(f"✗ Error retrieving recommendations for {user_id}: {str(e)}")
+            return None
+
+    def get_user_recommendations(self, user_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Retrieve cached recommendations for a user (< 0.1s response)
+        
+        Args:
+            user_id: Unique user identifier
+        
+        Returns:
+            List of recommendations or None if not cached
+        """
+        entry = self.get_user_entry(user_id)
+        return entry["recommendations"] if entry else None
+
     def store_batch_recommendations(
         self, 
         user_recommendations: Dict[str, List[Dict[str, Any]]], 
@@ -101,29 +270,27 @@ class UpstashClient:
         
         Args:
             user_recommendations: Dict mapping user_id to their recommendations
-            expiry_hours: TTL in hours
+            expiry_hours: Hours the lists are fresh; keys live CACHE_STALE_HOURS longer
         
         Returns:
             Dict with success status for each user
         """
         try:
             pipeline = self.sync_redis.pipeline()
-            expiry_seconds = expiry_hours * 3600
             
             results = {}
+            timestamp = int(time.time())
             for user_id, recommendations in user_recommendations.items():
                 key = f"recommendations:{user_id}"
-                value = json.dumps({
-                    "user_id": user_id,
-                    "recommendations": recommendations,
-                    "timestamp": int(__import__('time').time())
-                })
+                value = encode_recommendations(user_id, recommendations, timestamp)
                 
-                pipeline.setex(key, expiry_seconds, value)
+                pipeline.setex(key, _hard_ttl(user_id, timestamp, expiry_hours), value)
                 results[user_id] = True
             
             # Execute pipeline
             pipeline.exec()
+            for user_id in user_recommendations:
+                self.local_cache.invalidate(f"recommendations:{user_id}")
             logger.info(f"✓ Batch stored recommendations for {len(user_recommendations)} users")
             return results
             
@@ -131,11 +298,54 @@ class UpstashClient:
             logger.error(f"✗ Error in batch storage: {str(e)}")
             return {uid: False for uid in user_recommendations.keys()}
 
+    def get_ttls(self, user_ids: List[str]) -> List[int]:
+        """
+        Remaining TTL in seconds of each user's cached entry, in one pipeline
+        (-2 = not cached, -1 = no expiry)
+        """
+        if not user_ids:
+            return []
+        pipeline = self.sync_redis.pipeline()
+        for user_id in user_ids:
+            pipeline.ttl(f"recommendations:{user_id}")
+        return [int(ttl) for ttl in pipeline.exec()]
+
+    async def aacquire_refresh_lock(self, user_id: str, ttl_seconds: int) -> Optional[str]:
+        """
+        Claim the short-lived lock that lets one caller queue a refresh for this user.
+        Returns the lock token (hand it to the refresh so it can release the lock),
+        or None if someone else holds it; fails open so a Redis error never blocks refreshes.
+        """
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.async_redis.set(f"refresh_lock:{user_id}", token, nx=True, ex=ttl_seconds)
+            return token if acquired else None
+        except Exception as e:
+            logger.error(f"✗ Error acquiring refresh lock for {user_id}: {str(e)}")
+            return token
+
+    def acquire_lock(self, key: str, ttl_seconds: int) -> Optional[str]:
+        """Claim `key` if nobody holds it (SET NX EX); returns the token to release it with, or None"""
+        token = uuid.uuid4().hex
+        return token if self.sync_redis.set(key, token, nx=True, ex=ttl_seconds) else None
+
+    def release_lock(self, key: str, token: str):
+        """Delete `key` only if it still holds our token (it may have expired and been claimed since)"""
+        try:
+            self.sync_redis.eval(_RELEASE_LOCK_SCRIPT, keys=[key], args=[token])
+        except Exception as e:
+            logger.error(f"✗ Error releasing lock {key}: {str(e)}")
+
+    def release_refresh_lock(self, user_id: str, token: str):
+        """Drop the refresh lock once the refresh has finished (or failed), if it still holds our token"""
+        self.release_lock(f"refresh_lock:{user_id}", token)
+
     def clear_recommendations(self, user_id: str) -> bool:
         """Delete recommendations for a user"""
         try:
             key = f"recommendations:{user_id}"
             self.sync_redis.delete(key)
+            self.local_cache.invalidate(key)
             logger.info(f"✓ Cleared recommendations for user {user_id}")
             return True
         except Exception as e:
@@ -0,0 +1,240 @@
+# user_embedding_store.py
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from file_lock import file_lock
+from config import USER_EMBEDDINGS_DIR, USER_EMBEDDING_DTYPE, SBERT_MODEL_NAME, ENCODE_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# user ids are ObjectId hex strings, stored as fixed-width bytes
+ID_BYTES = 24
+
+
+def profile_hashes(texts) -> np.ndarray:
+    """64-bit content hash per profile text (uint64)."""
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+            for text in texts
+        ),
+        dtype=np.uint64,
+        count=len(texts),
+    )
+
+
+class UserEmbeddingStore:
+    """
+    Persistent cache of user profile embeddings, so SBERT only runs for users
+    whose profile text changed since it was last encoded.
+
+    On disk (one directory) it is three parallel, append-only arrays with one
+    row per user: vectors.bin (rows x dim, float16 by default), hashes.bin
+    (uint64 hash of the profile text) and ids.bin (24-byte user ids), plus
+    meta.json with the dim, dtype and SBERT model name. vectors and hashes are
+    memory-mapped and updated in place; new users are appended. ids.bin is
+    written last, so its length is the committed row count. Writers serialise
+    on an flock, so Celery workers on one machine can share a directory.
+    """
+
+    def __init__(self, directory: str = USER_EMBEDDINGS_DIR, dtype: str = USER_EMBEDDING_DTYPE,
+                 model_name: str = SBERT_MODEL_NAME):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.model_name = model_name
+        os.makedirs(directory, exist_ok=True)
+
+        self._vectors_path = os.path.join(directory, "vectors.bin")
+        self._hashes_path = os.path.join(directory, "hashes.bin")
+        self._ids_path = os.path.join(directory, "ids.bin")
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._lock_path = os.path.join(directory, ".lock")
+
+        self.dim = None
+        self.vectors = np.zeros((0, 0), dtype=self.dtype)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self._index: Dict[str, int] = {}
+        self._pending: Dict[str, Tuple[int, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+        with self._file_lock():
+            self._check_meta()
+        self.reload()
+
+    def __len__(self):
+        return len(self._index)
+
+    # -------- on-disk state --------
+
+    def _file_lock(self):
+        return file_lock(self._lock_path)
+
+    def _check_meta(self):
+        """Drop the stored embeddings if they came from another model or dtype (caller holds the file lock)."""
+        if not os.path.exists(self._meta_path):
+            self._clear_files()
+            return
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if meta.get("model") == self.model_name and meta.get("dtype") == self.dtype.name:
+            self.dim = int(meta["dim"])
+            return
+        logger.info(f"[USER_EMB] model/dtype changed, clearing {self.directory}")
+        self._clear_files()
+
+    def _clear_files(self):
+        for path in (self._ids_path, self._hashes_path, self._vectors_path, self._meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.dim = None
+
+    def _committed_rows(self) -> int:
+        if not os.path.exists(self._ids_path):
+            return 0
+        return os.path.getsize(self._ids_path) // ID_BYTES
+
+    def reload(self):
+        """Pick up rows appended by other processes since the last load."""
+        rows = self._committed_rows() if self.dim is not None else 0
+        if rows == 0:
+            self._index = {}
+            self.vectors = np.zeros((0, self.dim or 0), dtype=self.dtype)
+            self.hashes = np.zeros(0, dtype=np.uint64)
+            return
+        if rows == len(self._index) and isinstance(self.vectors, np.memmap):
+            return
+
+        ids = np.fromfile(self._ids_path, dtype=f"S{ID_BYTES}", count=rows)
+        index = dict(self._index) if rows > len(self._index) else {}
+        for row in range(len(index), rows):
+            index[ids[row].decode("ascii")] = row
+        self._index = index
+
+        self.vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode="r+", shape=(rows, self.dim))
+        self.hashes = np.memmap(self._hashes_path, dtype=np.uint64, mode="r+", shape=(rows,))
+
+    # -------- lookups --------
+
+    def rows(self, user_ids) -> np.ndarray:
+        """Row per user id, -1 for users not in the store."""
+        index = self._index
+        return np.fromiter((index.get(str(u), -1) for u in user_ids), dtype=np.int64, count=len(user_ids))
+
+    def encode(self, user_ids: List[str], texts: List[str], model, batch_size: int = ENCODE_BATCH_SIZE) -> np.ndarray:
+        """
+        float32 embeddings for users' profile texts. Users whose stored hash
+        matches their current text are served from the store; the rest are
+        encoded with `model` in one call and staged for the next flush().
+        """
+        if len(texts) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        with self._lock:
+            self.reload()
+            hashes = profile_hashes(texts)
+            rows = self.rows(user_ids)
+            cached = rows >= 0
+            cached[cached] = self.hashes[rows[cached]] == hashes[cached]
+
+            if not cached.all():
+                encoded = np.asarray(
+                    model.encode([texts[i] for i in np.flatnonzero(~cached)],
+                                 batch_size=batch_size, convert_to_numpy=True),
+                    dtype=np.float32,
+                )
+                if self.dim is not None and encoded.shape[1] != self.dim:
+                    # model output changed shape without a name change: nothing stored is usable
+                    cached[:] = False
+                    encoded = np.asarray(
+                        model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True),
+                        dtype=np.float32,
+                    )
+            stale = np.flatnonzero(~cached)
+
+            out = np.empty((len(texts), encoded.shape[1] if stale.size else self.dim), dtype=np.float32)
+            if cached.any():
+                out[cached] = self.vectors[rows[cached]]
+            if stale.size:
+                out[stale] = encoded
+                for pos, i in enumerate(stale):
+                    user_id = str(user_ids[i])
+                    if len(user_id) == ID_BYTES:
+                        self._pending[user_id] = (int(hashes[i]), encoded[pos])
+
+            logger.info(f"[USER_EMB] {int(cached.sum())}/{len(texts)} embeddings reused, {stale.size} encoded")
+            return out
+
+    # -------- writes --------
+
+    def flush(self) -> int:
+        """Persist embeddings staged by encode(). Returns the number of users written."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+
+            with self._file_lock():
+                self._check_meta()
+                dim = len(next(iter(pending.values()))[1])
+                if self.dim is not None and dim != self.dim:
+                    self._clear_files()
+                if self.dim is None:
+                    self.dim = dim
+                    with open(self._meta_path, "w") as f:
+                        json.dump({"dim": dim, "dtype": self.dtype.name, "model": self.model_name}, f)
+                    self._index = {}
+                self.reload()
+
+                updates = [(self._index[u], h, v) for u, (h, v) in pending.items() if u in self._index]
+                appends = [(u, h, v) for u, (h, v) in pending.items() if u not in self._index]
+
+                if updates:
+                    rows = np.array([row for row, _, _ in updates])
+                    self.vectors[rows] = np.stack([v for _, _, v in updates]).astype(self.dtype)
+                    self.hashes[rows] = np.array([h for _, h, _ in updates], dtype=np.uint64)
+                    self.vectors.flush()
+                    self.hashes.flush()
+
+                if appends:
+                    self._append(appends)
+
+                self.reload()
+
+            logger.info(f"[USER_EMB] stored {len(updates)} updated and {len(appends)} new user embeddings")
+            return len(pending)
+
+    def _append(self, appends):
+        """Append rows (caller holds the file lock). ids go last: they commit the rows."""
+        committed = len(self._index)
+        vectors = np.stack([v for _, _, v in appends]).astype(self.dtype)
+        hashes = np.array([h for _, h, _ in appends], dtype=np.uint64)
+        ids = np.array([u.encode("ascii") for u, _, _ in appends], dtype=f"S{ID_BYTES}")
+
+        # a crash mid-append can leave uncommitted tail bytes; cut them before writing
+        for path, row_bytes, data in (
+            (self._vectors_path, self.dim * self.dtype.itemsize, vectors),
+            (self._hashes_path, hashes.itemsize, hashes),
+            (self._ids_path, ID_BYTES, ids),
+        ):
+            with open(path, "ab") as f:
+                f.truncate(committed * row_bytes)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+
+_store = None
+
+
+def get_user_embedding_store():
+    global _store
+    if _store is None:
+        _store = UserEmbeddingStore()
+    return _store